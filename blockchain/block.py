@@ -1,68 +1,249 @@
 import json
-import hashlib
-import binascii
 
 from time import time
 from datetime import datetime
 
+from .block_header import (
+    BlockHeader,
+    BLOCK_VERSION,
+    DEFAULT_BITS,
+    compute_transactions_root,
+    get_double_sha256,
+    hash_meets_target,
+)
+from .merkle_tree import compute_merkle_root, get_leaf_hash, is_mutated_merkle_tree
+from .mining_engine import get_midstate, get_pow_digest
+from transaction.transactions import get_transaction_hash, is_well_formed_transaction
+
+
+GENESIS_TRANSACTIONS = 'AD9B477B42B22CDF18B1335603D07378ACE83561D8398FBFC8DE94196C65D806'
+GENESIS_NONCE = 107496
+GENESIS_HASH = '0000016c13ba5d12d111651f3e2f965bc4f78a0c658edfcdfcff89be6a70e139'
+
 
 class Block:
-    def __init__(self, transactions, previous_block_hash):
+    def __init__(self, transactions, previous_block_hash, mining_engine=None, bits=DEFAULT_BITS, generation=None):
         snap_tr = json.dumps(transactions) # Pow計算中に値が変わるのでブロック計算開始時の値を退避する
 
+        self.version = BLOCK_VERSION
         self.timestamp = time()
-        self.transactions = json.loads(snap_tr)
+        self.transactions = [json.dumps(t) for t in json.loads(snap_tr)]
+        self.transactions_root = compute_transactions_root(self.transactions)
         self.previous_block = previous_block_hash
+        self.bits = bits
+        self.nonce = 0
 
         current = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
         print(current)
 
-        json_block = json.dumps(self.to_dict(include_nonce=False), sort_keys=True)
-        print('json_block: ', json_block)
-        self.nonce = self._compute_nonce_for_pow(json_block)
+        header = self.get_header()
+        print('block header: ', header.get_prefix().hex())
+        if mining_engine is not None:
+            self.nonce = mining_engine.compute_nonce(header.get_prefix(), header.get_target(), generation)
+        else:
+            self.nonce = self._compute_nonce_for_pow(header)
 
         current2 = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
         print(current2)
 
-    def to_dict(self, include_nonce=True):
+    def get_header(self):
+        return BlockHeader(
+            self.version,
+            self.previous_block,
+            self.transactions_root,
+            self.timestamp,
+            self.bits,
+            self.nonce,
+        )
+
+    def to_dict(self):
         d = {
+            'version': self.version,
             'timestamp': self.timestamp,
-            'transactions': json.dumps(self.transactions),
+            'transactions': self.transactions,
+            'transactions_root': self.transactions_root,
             'previous_block': self.previous_block,
+            'bits': self.bits,
+            'nonce': self.nonce,
         }
 
-        if include_nonce:
-            d['nonce'] = self.nonce
-
         return d
 
-    def _compute_nonce_for_pow(self, message, difficulty=5):
+    def seal(self):
+        return SealedBlock(self.to_dict())
+
+    def _compute_nonce_for_pow(self, header):
         i = 0
-        suffix = '0' * difficulty
+        target = header.get_target()
+        midstate = get_midstate(header.get_prefix())
         while True:
-            nonce = str(i) # 0から総当たりで数を増やしてsuffixを満たす値を探す
-            digest = binascii.hexlify(self._get_double_sha256((message + nonce).encode('utf-8'))).decode('ascii')
+            # 0から総当たりで数を増やしてtarget以下のハッシュ値になる値を探す
+            digest = get_pow_digest(midstate, i)
 
-            if digest.endswith(suffix):
-                return nonce
+            if int.from_bytes(digest, 'big') <= target:
+                return i
             i += 1
 
-    def _get_double_sha256(self, message):
-        return hashlib.sha256(hashlib.sha256(message).digest()).digest()
-
 
 class GenesisBlock(Block):
+    """
+    Genesisブロックの内容は常に同じなので、事前に計算済みのnonceとハッシュ値を使って起動時のPoWを省略する
+    """
     def __init__(self):
-        super().__init__(transactions='AD9B477B42B22CDF18B1335603D07378ACE83561D8398FBFC8DE94196C65D806', previous_block_hash=None)
+        self.version = BLOCK_VERSION
+        self.timestamp = 0.0
+        self.transactions = [GENESIS_TRANSACTIONS]
+        self.transactions_root = compute_transactions_root(self.transactions)
+        self.previous_block = None
+        self.bits = DEFAULT_BITS
+        self.nonce = GENESIS_NONCE
+
+    def is_valid(self):
+        """
+        ハードコードされた値が正しいことをハッシュ計算1回分で確認する
+        """
+        header = self.get_header()
+        return header.meets_target() and header.get_hash() == GENESIS_HASH
+
+    def to_dict(self):
+        d = super().to_dict()
+        d['genesis_block'] = True
 
-    def to_dict(self, include_nonce=True):
+        return d
+
+
+class SealedBlock:
+    """
+    チェーンに格納するブロック。生成後は内容を変更しない前提で、ヘッダのバイト列とハッシュ値は
+    生成時に一度だけ計算して保持し、検証や中継、prev_block_hashの管理ではそれを使い回す
+    """
+    __slots__ = (
+        '_header', '_transactions', '_is_genesis', '_header_bytes', '_digest', '_hash', '_json', '_has_valid_root',
+        '_transaction_ids', '_parsed_transactions',
+    )
+
+    def __init__(self, block):
+        self._header = BlockHeader.from_dict(block)
+        self._transactions = tuple(block['transactions'])
+        self._is_genesis = block.get('genesis_block', False)
+        self._header_bytes = self._header.serialize()
+        self._digest = get_double_sha256(self._header_bytes)
+        self._hash = self._digest.hex()
+        self._json = None
+        self._has_valid_root = None
+        self._transaction_ids = None
+        self._parsed_transactions = None
+
+    @property
+    def hash(self):
+        return self._hash
+
+    @property
+    def header(self):
+        return self._header
+
+    @property
+    def header_bytes(self):
+        return self._header_bytes
+
+    @property
+    def previous_block(self):
+        return self._header.previous_block
+
+    @property
+    def transactions(self):
+        return self._transactions
+
+    @property
+    def transaction_ids(self):
+        """
+        ブロック内の各Transactionのtxid。最初に参照された時に一度だけ計算する(ジェネシスブロックは対象外)
+        """
+        if self._transaction_ids is None:
+            self.parse_transactions()
+        return self._transaction_ids
+
+    def parse_transactions(self):
+        """
+        Transactionを解析したdictのリストを返却する。受信したブロックの検証、手数料の計算、接続で同じ解析結果を
+        使い回せるよう、release_parsed_transactionsが呼ばれるまで保持する。txidも最初の解析で求めて保持する
+        返却したdictは共有されるので呼び出し側で変更しないこと
+        """
+        if self._is_genesis:
+            self._transaction_ids = ()
+            return []
+
+        if self._parsed_transactions is None:
+            transactions = [json.loads(t) for t in self._transactions]
+            if self._transaction_ids is None:
+                self._transaction_ids = tuple(get_transaction_hash(t) for t in transactions)
+            self._parsed_transactions = transactions
+        return self._parsed_transactions
+
+    def release_parsed_transactions(self):
+        """
+        チェーンに接続した後は解析結果を使わないので、チェーン全体分のdictを抱え込まないように手放す
+        """
+        self._parsed_transactions = None
+
+    def has_well_formed_transactions(self):
+        """
+        全てのTransactionがJSONとして解析でき、チェーンへの接続と検証に使うキーを持っているか確認する
+        """
+        if self._is_genesis:
+            return True
+        try:
+            transactions = self.parse_transactions()
+        except (TypeError, ValueError):
+            return False
+        return all(is_well_formed_transaction(t) for t in transactions)
+
+    @property
+    def is_genesis(self):
+        return self._is_genesis
+
+    def meets_target(self):
+        return hash_meets_target(self._digest, self._header.get_target())
+
+    def has_valid_transactions_root(self):
+        if self._has_valid_root is None:
+            if not all(isinstance(t, str) for t in self._transactions):
+                self._has_valid_root = False
+                return False
+            # 末尾のTransactionを重複させた本体は同じルートになるので、重複を含む木はルートが一致しても受け入れない
+            leaves = [get_leaf_hash(t) for t in self._transactions]
+            self._has_valid_root = (
+                not is_mutated_merkle_tree(leaves)
+                and compute_merkle_root(leaves) == self._header.transactions_root
+            )
+        return self._has_valid_root
+
+    def to_dict(self):
         d = {
-            'transactions': self.transactions,
-            'genesis_block': True,
+            'version': self._header.version,
+            'timestamp': self._header.timestamp,
+            'transactions': list(self._transactions),
+            'transactions_root': self._header.transactions_root,
+            'previous_block': self._header.previous_block,
+            'bits': self._header.bits,
+            'nonce': self._header.nonce,
         }
 
-        if include_nonce:
-            d['nonce'] = self.nonce
+        if self._is_genesis:
+            d['genesis_block'] = True
 
         return d
 
+    def to_json(self):
+        if self._json is None:
+            self._json = json.dumps(self.to_dict())
+        return self._json
+
+    def __eq__(self, other):
+        return isinstance(other, SealedBlock) and self._hash == other._hash
+
+    def __hash__(self):
+        return hash(self._hash)
+
+    def __repr__(self):
+        return 'SealedBlock({})'.format(self._hash)
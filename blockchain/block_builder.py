@@ -1,17 +1,36 @@
 from .block import Block
 from .block import GenesisBlock
+from .mining_engine import MiningEngine
 
 
 class BlockBuilder:
     def __init__(self):
         print('Initializing BlockBuilder...')
-        pass
+        self.mining_engine = MiningEngine()
 
     def generate_genesis_block(self):
         genesis_block = GenesisBlock()
+        if not genesis_block.is_valid():
+            raise RuntimeError('Precomputed genesis block is broken')
         return genesis_block
 
-    def generate_new_block(self, transaction, previous_block_hash):
-        new_block = Block(transaction, previous_block_hash)
+    def get_mining_generation(self):
+        return self.mining_engine.get_generation()
+
+    def generate_new_block(self, transaction, previous_block_hash, generation=None):
+        """
+        generationにはprevious_block_hashを読む前にget_mining_generationで取得した値を渡す
+        それ以降にstop_block_buildingが呼ばれていればPoWを計算せずにNoneを返却する
+        """
+        new_block = Block(transaction, previous_block_hash, self.mining_engine, generation=generation)
+        if new_block.nonce is None:
+            print('Block building was cancelled...')
+            return None
         return new_block
 
+    def stop_block_building(self):
+        self.mining_engine.cancel()
+
+    def shutdown(self):
+        self.mining_engine.shutdown()
+
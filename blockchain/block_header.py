@@ -0,0 +1,124 @@
+import struct
+import hashlib
+import binascii
+
+from .merkle_tree import compute_merkle_root, get_leaf_hash
+
+
+BLOCK_VERSION = 1
+
+# version, previous_block, transactions_root, timestamp, bits, nonce の固定長バイナリ(リトルエンディアン)
+HEADER_FORMAT = struct.Struct('<I32s32sdIQ')
+NONCE_FORMAT = struct.Struct('<Q')
+HEADER_PREFIX_SIZE = HEADER_FORMAT.size - NONCE_FORMAT.size
+
+# 先頭20bitが0(= 従来のdifficulty=5相当)
+DEFAULT_BITS = 0x1e0fffff
+# 受け入れる最も易しいtarget(先頭12bitが0 = 従来の検証時のdifficulty=3相当)
+MAX_TARGET_BITS = 0x1f0fffff
+
+NULL_HASH = bytes(32)
+
+
+def get_double_sha256(message):
+    return hashlib.sha256(hashlib.sha256(message).digest()).digest()
+
+
+def bits_to_target(bits):
+    """
+    compact形式(上位1byteが桁数、下位3byteが仮数)のbitsを整数のtargetに変換する
+    """
+    exponent = bits >> 24
+    mantissa = bits & 0xffffff
+    if exponent <= 3:
+        return mantissa >> (8 * (3 - exponent))
+    return mantissa << (8 * (exponent - 3))
+
+
+def target_to_bits(target):
+    size = (target.bit_length() + 7) // 8
+    if size <= 3:
+        mantissa = target << (8 * (3 - size))
+    else:
+        mantissa = target >> (8 * (size - 3))
+    # 仮数の最上位bitは符号扱いになるので桁を1つずらす
+    if mantissa & 0x800000:
+        mantissa >>= 8
+        size += 1
+    return (size << 24) | mantissa
+
+
+MAX_TARGET = bits_to_target(MAX_TARGET_BITS)
+
+
+def hash_meets_target(block_hash, target):
+    return int.from_bytes(block_hash, 'big') <= target
+
+
+def compute_transactions_root(transactions):
+    return compute_merkle_root([get_leaf_hash(t) for t in transactions])
+
+
+class BlockHeader:
+    """
+    PoWの対象となるブロックヘッダ。ハッシュ計算は常にこの固定長のバイト列に対して行う
+    """
+
+    def __init__(self, version, previous_block, transactions_root, timestamp, bits, nonce=0):
+        self.version = version
+        self.previous_block = previous_block
+        self.transactions_root = transactions_root
+        self.timestamp = timestamp
+        self.bits = bits
+        self.nonce = nonce
+
+    @classmethod
+    def from_dict(cls, block):
+        return cls(
+            block['version'],
+            block['previous_block'],
+            block['transactions_root'],
+            block['timestamp'],
+            block['bits'],
+            block['nonce'],
+        )
+
+    @classmethod
+    def deserialize(cls, header_bytes):
+        version, previous_block, transactions_root, timestamp, bits, nonce = HEADER_FORMAT.unpack(header_bytes)
+        if previous_block == NULL_HASH:
+            previous_block = None
+        else:
+            previous_block = binascii.hexlify(previous_block).decode('ascii')
+        transactions_root = binascii.hexlify(transactions_root).decode('ascii')
+        return cls(version, previous_block, transactions_root, timestamp, bits, nonce)
+
+    def serialize(self):
+        return HEADER_FORMAT.pack(
+            self.version,
+            self._hex_to_bytes(self.previous_block),
+            self._hex_to_bytes(self.transactions_root),
+            self.timestamp,
+            self.bits,
+            self.nonce,
+        )
+
+    def get_prefix(self):
+        """
+        nonceを除いた先頭部分。PoW計算中はこの部分のmidstateを使い回す
+        """
+        return self.serialize()[:HEADER_PREFIX_SIZE]
+
+    def get_target(self):
+        return bits_to_target(self.bits)
+
+    def get_hash(self):
+        return binascii.hexlify(get_double_sha256(self.serialize())).decode('ascii')
+
+    def meets_target(self):
+        return hash_meets_target(get_double_sha256(self.serialize()), self.get_target())
+
+    def _hex_to_bytes(self, hex_text):
+        if hex_text is None:
+            return NULL_HASH
+        return binascii.unhexlify(hex_text)
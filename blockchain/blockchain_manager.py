@@ -1,62 +1,255 @@
 import json
-import hashlib
-import binascii
 import threading
-import copy
-import pickle
+
+from .block_header import (
+    BlockHeader,
+    MAX_TARGET,
+)
+from .block import SealedBlock
+from .merkle_tree import get_leaf_hash, get_merkle_proof
+from transaction.transactions import TransactionOutput, get_outpoint
+
+
+# チェーン全体を送信する時の1chunkあたりのブロック数
+CHAIN_CHUNK_BLOCKS = 50
+
+
+class BlockUndo:
+    """
+    ブロック接続時にインデックスへ加えた変更の記録。チェーンの繋ぎ変えでブロックを切り離す時に使う
+    """
+
+    def __init__(self):
+        self.spent_outpoints = []
+        self.created_outpoints = []
+        self.transaction_hashes = []
+        # 切り離された時にTransactionPoolへ戻す候補(CoinbaseTransaction以外)の(txid, ブロック内の位置)
+        # Transaction本体はチェーン全体分保持するとメモリを圧迫するので、切り離す時にブロックから解析し直す
+        self.pool_transactions = []
 
 
 class BlockchainManager:
     def __init__(self, genesis_block):
         print('Initializing BlockchainManager...')
         self.chain = []
+        # ブロックのハッシュ値 -> 高さ、高さ -> ハッシュ値 のインデックス
+        self.height_by_hash = {}
+        self.hash_by_height = []
+        # チェーン内でInputとして使用済みの出力(outpoint)の集合
+        self.spent_outpoints = set()
+        # チェーン内で作られた出力。outpoint -> TransactionOutput
+        self.created_outputs = {}
+        # チェーンに取り込み済みのTransactionのハッシュ値 -> 含まれるブロックのハッシュ値
+        self.confirmed_transactions = {}
+        # 接続中のブロックのハッシュ値 -> BlockUndo
+        self.undo_records = {}
+        # チェーン送信用にエンコード済みのchunk。chunkの番号 -> (先頭の親のハッシュ値, 末尾のハッシュ値, JSON文字列)
+        self.chain_chunk_cache = {}
         self.lock = threading.Lock()
         self.__set_my_genesis_block(genesis_block)
 
     def __set_my_genesis_block(self, block):
         self.genesis_block = block
+        self.__append_block(block)
+
+    def __append_block(self, block):
+        # 解析で例外が起きてもチェーンとインデックスが食い違わないよう、undoレコードを作り終えてから変更する
+        undo, created_outputs = self.__build_undo(block)
+        self.height_by_hash[block.hash] = len(self.chain)
+        self.hash_by_height.append(block.hash)
         self.chain.append(block)
+        self.__invalidate_chain_chunk(len(self.chain) - 1)
+        self.__connect_outputs(block, undo, created_outputs)
+
+    def __remove_tip_block(self):
+        block = self.chain.pop()
+        self.hash_by_height.pop()
+        del self.height_by_hash[block.hash]
+        self.__invalidate_chain_chunk(len(self.chain))
+        return block, self.__disconnect_outputs(block)
+
+    def __invalidate_chain_chunk(self, height):
+        # ブロックの接続・切り離しで内容が変わるのはそのブロックを含むchunkだけ
+        self.chain_chunk_cache.pop((height - 1) // CHAIN_CHUNK_BLOCKS, None)
+
+    def __build_undo(self, block):
+        """
+        ブロック内のTransactionを解析し、接続時にインデックスへ加える変更をundoレコードと新しい出力の組で返却する
+        インデックスはまだ変更しない
+        """
+        undo = BlockUndo()
+        created_outputs = {}
+        transactions = block.parse_transactions()
+        for index, (t_hash, t) in enumerate(zip(block.transaction_ids, transactions)):
+            undo.transaction_hashes.append(t_hash)
+            if t['t_type'] != 'coinbase_transaction':
+                undo.pool_transactions.append((t_hash, index))
+            if t['t_type'] == 'basic' or t['t_type'] == 'coinbase_transaction':
+                for txin in t['inputs']:
+                    undo.spent_outpoints.append(get_outpoint(txin))
+                for idx, txout in enumerate(t['outputs']):
+                    undo.created_outpoints.append((t_hash, idx))
+                    created_outputs[(t_hash, idx)] = TransactionOutput.from_dict(txout)
+
+        return undo, created_outputs
+
+    def __connect_outputs(self, block, undo, created_outputs):
+        """
+        ブロックを接続してインデックスを更新し、切り離す時のためのundoレコードを残す
+        """
+        self.created_outputs.update(created_outputs)
+        self.confirmed_transactions.update((t_hash, block.hash) for t_hash in undo.transaction_hashes)
+        self.spent_outpoints.update(undo.spent_outpoints)
+        self.undo_records[block.hash] = undo
+        block.release_parsed_transactions()
+
+    def __disconnect_outputs(self, block):
+        """
+        undoレコードを使ってブロック接続時の変更を取り消す。チェーンの再走査やJSONの再解析はしない
+        """
+        undo = self.undo_records.pop(block.hash)
+        for t_hash in undo.transaction_hashes:
+            self.confirmed_transactions.pop(t_hash, None)
+        self.spent_outpoints.difference_update(undo.spent_outpoints)
+        for outpoint in undo.created_outpoints:
+            self.created_outputs.pop(outpoint, None)
+        return undo
 
     def set_new_block(self, block):
         with self.lock:
-            self.chain.append(block)
+            self.__append_block(block)
 
-    def is_valid_block(self, prev_block_hash, block, difficulty=3):
-        suffix = '0' * difficulty
-        block_4_pow = copy.deepcopy(block)
-        nonce = block_4_pow['nonce']
-        del block_4_pow['nonce']
-        print(block_4_pow)
+    def has_block(self, block_hash):
+        return block_hash in self.height_by_hash
 
-        message = json.dumps(block_4_pow, sort_keys=True)
-        nonce = str(nonce)
+    def get_block_height(self, block_hash):
+        return self.height_by_hash.get(block_hash)
 
-        if block['previous_block'] != prev_block_hash:
+    def get_block_by_hash(self, block_hash):
+        height = self.height_by_hash.get(block_hash)
+        if height is None:
+            return None
+        return self.chain[height]
+
+    def get_block_hash_at(self, height):
+        if 0 <= height < len(self.hash_by_height):
+            return self.hash_by_height[height]
+        return None
+
+    def get_latest_block_hash(self):
+        return self.hash_by_height[-1]
+
+    def get_block_locator(self):
+        """
+        最新のブロックから直近10個は1つずつ、それより前は間隔を倍々に広げて選んだハッシュ値のリスト
+        相手はこの中で最初に自分も持っているブロックを共通の祖先として、それ以降のブロックだけを返せばよい
+        """
+        locator = []
+        height = len(self.hash_by_height) - 1
+        step = 1
+        while height > 0:
+            locator.append(self.hash_by_height[height])
+            if len(locator) >= 10:
+                step *= 2
+            height -= step
+        locator.append(self.hash_by_height[0])
+        return locator
+
+    def get_blocks_after_locator(self, locator, max_blocks):
+        """
+        locatorの中で最初に見つかった自分のブロックより後ろのブロックを最大max_blocks個返却する
+        まだ後ろにブロックが残っているかどうかも合わせて返却する
+        """
+        with self.lock:
+            start = None
+            for block_hash in locator:
+                start = self.height_by_hash.get(block_hash)
+                if start is not None:
+                    break
+
+            if start is None:
+                return [], False
+
+            blocks = self.chain[start + 1:start + 1 + max_blocks]
+            has_more = start + 1 + max_blocks < len(self.chain)
+            return blocks, has_more
+
+    def get_encoded_chain_chunk(self, index):
+        """
+        ジェネシスブロックより後ろのブロックをCHAIN_CHUNK_BLOCKS個ずつ区切ったindex番目のchunkを
+        ブロックのdictのリストのJSON文字列として返却する。エンコード結果はブロックが接続・切り離されるまで
+        使い回し、同時に要求された場合もエンコードは1回だけ行う
+        戻り値は(先頭のブロックの親のハッシュ値, 末尾のブロックのハッシュ値, JSON文字列, 後ろにchunkが残っているか)
+        """
+        with self.lock:
+            start = index * CHAIN_CHUNK_BLOCKS + 1
+            if start >= len(self.chain):
+                return None
+
+            entry = self.chain_chunk_cache.get(index)
+            if entry is None:
+                blocks = self.chain[start:start + CHAIN_CHUNK_BLOCKS]
+                encoded = '[' + ', '.join(b.to_json() for b in blocks) + ']'
+                entry = (blocks[0].previous_block, blocks[-1].hash, encoded)
+                self.chain_chunk_cache[index] = entry
+
+            has_more = start + CHAIN_CHUNK_BLOCKS < len(self.chain)
+            return entry + (has_more,)
+
+    def is_valid_block(self, prev_block_hash, block, max_target=MAX_TARGET):
+        header = block.header
+        print(block)
+
+        if block.previous_block != prev_block_hash:
             print('Invalid block (bad previous_block)')
-            print(block['previous_block'])
+            print(block.previous_block)
             print(prev_block_hash)
             return False
+        elif not block.has_valid_transactions_root():
+            print('Invalid block (bad transactions_root)')
+            return False
+        elif header.get_target() > max_target:
+            print('Invalid block (too easy target)')
+            print('bits: ', hex(header.bits))
+            return False
+        elif not block.meets_target():
+            print('Invalid block (bad nonce)')
+            print('nonce: ', header.nonce)
+            print('digest: ', block.hash)
+            print('target: ', hex(header.get_target()))
+            return False
+        elif not block.has_well_formed_transactions():
+            # PoWを確認した後で解析する(解析の方が重いので、PoWのない偽ブロックで負荷をかけられないように)
+            print('Invalid block (malformed transactions)')
+            return False
         else:
-            digest = binascii.hexlify(self._get_double_sha256((message + nonce)
-                .encode('utf-8'))).decode('ascii')
-            if digest.endswith(suffix):
-                print('OK, this seems valid block')
-                return True
-            else:
-                print('Invalid block (bad nonce)')
-                print('nonce: ', nonce)
-                print('digest: ', digest)
-                print('suffix: ', suffix)
-                return False
-    
+            print('OK, this seems valid block')
+            return True
+
+    def is_valid_header(self, prev_block_hash, header, max_target=MAX_TARGET):
+        """
+        ブロック本体を持たずにヘッダだけでPoWと前のブロックとの繋がりを検証する(headers-first同期用)
+        """
+        if header.previous_block != prev_block_hash:
+            print('Invalid header (bad previous_block)')
+            return False
+        elif header.get_target() > max_target:
+            print('Invalid header (too easy target)')
+            return False
+        elif not header.meets_target():
+            print('Invalid header (bad nonce)')
+            return False
+
+        return True
+
     def is_valid_chain(self, chain):
-        # チェーン全体の正当性を検証する
+        # チェーン全体の正当性を検証する(各ブロックのハッシュ値は保持済みのものを使う)
         last_block = chain[0]
         current_index = 1
 
         while current_index < len(chain):
             block = chain[current_index]
-            if self.is_valid_block(self.get_hash(last_block), block) is not True:
+            if self.is_valid_block(last_block.hash, block) is not True:
                 return False
 
             last_block = chain[current_index]
@@ -64,65 +257,47 @@ class BlockchainManager:
 
         return True
 
-    def has_this_output_in_my_chain(self, transaction_output):
+    def has_this_output_in_my_chain(self, outpoint):
         """
-        保存されているブロックチェーン内ですでにtransaction_outputが他のTransactionのInputとして
+        保存されているブロックチェーン内ですでにoutpointの出力が他のTransactionのInputとして
         使用されていないか確認する
         """
         print('has_this_output_in_my_chain was called!')
-        current_index = 1
-
-        if len(self.chain) == 1:
-            print('only the genesis block is in my chain')
-            return False
-
-        while current_index < len(self.chain):
-            block = self.chain[current_index]
-            transactions = block['transactions']
-
-            for t in transactions:
-                t = json.loads(t)
-                if t['t_type'] == 'basic' or t['t_type'] == 'coinbase_transaction':
-                    if t['inputs'] != []:
-                        inputs_t = t['inputs']
-                        for it in inputs_t:
-                            print(it['transaction']['outputs'][it['output_index']])
-                            if it['transaction']['outputs'][it['output_index']] == transaction_output:
-                                print('This TransactionOutput was already used', transaction_output)
-                                return True
-            current_index += 1
+        if outpoint in self.spent_outpoints:
+            print('This TransactionOutput was already used', outpoint)
+            return True
 
         return False
 
-    def is_valid_output_in_my_chain(self, transaction_output):
+    def is_valid_output_in_my_chain(self, outpoint):
         """
         チェーン内で認知されていない不正なTransactionを使ってないか確認
         (有効化するとテスト用にCoinbaseTransactionができなくなる)
         """
         print('is_valid_output_in_my_chain was called!')
-        current_index = 1
+        return outpoint in self.created_outputs
 
-        while current_index < len(self.chain):
-            block = self.chain[current_index]
-            transactions = block['transactions']
+    def get_output_in_my_chain(self, outpoint):
+        return self.created_outputs.get(outpoint)
 
-            for t in transactions:
-                t = json.loads(t)
-                if t['t_type'] == 'basic' or ['t_type'] == 'coinbase_transaction':
-                    outputs_t = t['outputs']
-                    for ot in outputs_t:
-                        if ot == transaction_output:
-                            return True
-            current_index += 1
-
-        return False
+    def get_transaction_proof(self, transaction_hash):
+        """
+        txidのTransactionについて、含まれるブロック、ブロック内のTransactionのJSON文字列とMerkle証明を返却する
+        クライアントはブロックヘッダのtransactions_rootとこの証明だけで包含を確認できる
+        含まれるブロックはconfirmed_transactionsのインデックスから直接引く
+        """
+        block = self.get_block_by_hash(self.confirmed_transactions.get(transaction_hash))
+        if block is None:
+            return None, None, []
 
-    def _get_double_sha256(self, message):
-        return hashlib.sha256(hashlib.sha256(message).digest()).digest()
+        index = block.transaction_ids.index(transaction_hash)
+        leaves = [get_leaf_hash(t) for t in block.transactions]
+        return block, block.transactions[index], get_merkle_proof(leaves, index)
 
     def get_hash(self, block):
-        block_string = json.dumps(block, sort_keys=True)
-        return binascii.hexlify(self._get_double_sha256((block_string).encode('utf-8'))).decode('ascii')
+        if isinstance(block, SealedBlock):
+            return block.hash
+        return BlockHeader.from_dict(block).get_hash()
 
     def get_stored_transactions_from_bc(self):
         print('get_stored_transactions_from_bc was called!')
@@ -131,7 +306,7 @@ class BlockchainManager:
 
         while current_index < len(self.chain):
             block = self.chain[current_index]
-            transactions = block['transactions']
+            transactions = block.transactions
 
             for t in transactions:
                 stored_transactions.append(json.loads(t))
@@ -140,86 +315,98 @@ class BlockchainManager:
 
         return stored_transactions
 
-    def get_transactions_from_orphan_blocks(self, orphan_blocks):
-        current_index = 1
-        new_transactions = []
-
-        while current_index < len(orphan_blocks):
-            block = orphan_blocks[current_index]
-            transactions = block['transactions']
-            target = self.remove_useless_transaction(transactions)
-            for t in target:
-                new_transactions.append(t)
-
-        return new_transactions
-
     def get_my_blockchain(self):
+        # 送信や表示に使うのでdictのリストとして返却する
         if len(self.chain) > 1:
-            return self.chain
+            return [b.to_dict() for b in self.chain]
         else:
             return None
 
     def get_my_chain_length(self):
         return len(self.chain)
 
-    def remove_useless_transaction(self, transaction_pool):
+    def has_transaction(self, transaction_hash):
         """
-        与えられたTransactionのリストに、すでに自分が管理するメインチェーンに含まれるTransactionがある場合、
-        そのTransactionを削除したTransactionのリストを返す
+        txidのTransactionがすでに自分が管理するメインチェーンに含まれているか確認する
         """
+        return transaction_hash in self.confirmed_transactions
 
-        if len(transaction_pool) != 0:
-            current_index = 1
-
-            while current_index < len(self.chain):
-                block = self.chain[current_index]
-                transactions = block['transactions']
-                for t in transactions:
-                    for t2 in transaction_pool:
-                        if t == json.dumps(t2):
-                            print('already exists in my blockchain : ', t2)
-                            transaction_pool.remove(t2)
-                current_index += 1
+    def get_transaction_hashes_in_block(self, block):
+        return list(block.transaction_ids)
 
-            return transaction_pool
-        else:
-            print('no transaction to be removed...')
+    def get_spent_outpoints_in_block(self, block):
+        # 接続済みのブロックでInputとして使われた出力。undoレコードに記録済みなので再解析しない
+        undo = self.undo_records.get(block.hash)
+        if undo is None:
             return []
+        return list(undo.spent_outpoints)
 
-    def resolve_conflicts(self, chain):
-        # 自分のブロックチェーンと比較して長い方を有効とす
-        mychain_len = len(self.chain)
-        new_chain_len = len(chain)
-
-        pool_4_orphan_blocks = copy.deepcopy(self.chain)
-        has_orphan = False
-
-        # 自分のチェーンの中でだけ処理済みとなっているTransactionを救出する
-        # 現在のチェーンに含まれていないブロックを全て取り出す。
-        # 時系列を考えての有効無効判定などはしない簡易処理
-        if new_chain_len > mychain_len:
-            for b in pool_4_orphan_blocks:
-                for b2 in chain:
-                    if b == b2:
-                        pool_4_orphan_blocks.remove(b)
-
-            result = self.renew_my_blockchain(chain)
-            print(result)
-            if result is not None:
-                return result, pool_4_orphan_blocks
-            else:
-                return None, []
-        else:
-            print('invalid chain cannot be set...')
-            return None, []
+    def resolve_branch(self, new_blocks, check_transactions=None):
+        """
+        自分のチェーン内のブロックから分岐した(または最新のブロックに続く)ブロックのリストを受け取り、
+        自分のチェーンより長くなる場合はそれを有効とする
+        最新のprev_block_hashと、TransactionPoolに戻すTransactionの(txid, Transaction)のリスト、
+        新たに取り込まれたためTransactionPoolから取り除くTransactionのハッシュ値のリストを返却する
+        check_transactionsを渡すと、各ブロックを繋ぐ直前(親までが接続された状態)にブロック内のTransactionを検証する
+        """
+        if len(new_blocks) == 0:
+            return None, [], []
+
+        fork_height = self.get_block_height(new_blocks[0].previous_block)
+        if fork_height is None:
+            print('the branch does not start from my chain...')
+            return None, [], []
 
-    def renew_my_blockchain(self, blockchain):
-        # ブロックチェーン自体を更新し、それによって変更されるはずの最新のprev_block_hashを計算して返却する
+        return self.renew_my_blockchain(fork_height, new_blocks, check_transactions)
+
+    def renew_my_blockchain(self, fork_height, new_blocks, check_transactions=None):
+        """
+        fork_heightのブロックより後ろをnew_blocksで置き換える。外れたブロックはundoレコードを使って1つずつ切り離し、
+        その中でだけ処理済みとなっていたTransactionを救出する
+        check_transactionsで不正と判定されたブロックがあるか、接続中に例外が起きた場合は元のチェーンに戻して何もしない
+        (check_transactionsはself.lockを取得中に呼ばれるので、このクラスのロックを取るメソッドは使えない)
+        """
         with self.lock:
-            if self.is_valid_chain(blockchain):
-                self.chain = blockchain
-                latest_block = self.chain[-1]
-                return self.get_hash(latest_block)
-            else:
+            if fork_height + 1 + len(new_blocks) <= len(self.chain):
+                print('my chain has been already extended...')
+                return None, [], []
+
+            # Transactionの形式もis_valid_blockで確認されるので、ここを通ったブロックは接続時の解析で失敗しない
+            if fork_height >= len(self.chain) or not self.is_valid_chain([self.chain[fork_height]] + new_blocks):
                 print('invalid chain cannot be set...')
-                return None
+                return None, [], []
+
+            disconnected = []
+            while len(self.chain) > fork_height + 1:
+                disconnected.append(self.__remove_tip_block())
+
+            confirmed_hashes = []
+            try:
+                for block in new_blocks:
+                    if check_transactions is not None and not check_transactions(block):
+                        print('invalid transactions in the branch. my chain is restored...')
+                        self.__restore_chain(fork_height, disconnected)
+                        return None, [], []
+                    self.__append_block(block)
+                    confirmed_hashes.extend(self.undo_records[block.hash].transaction_hashes)
+            except Exception as e:
+                print('failed to connect the branch. my chain is restored...', e)
+                self.__restore_chain(fork_height, disconnected)
+                return None, [], []
+
+            orphan_transactions = []
+            for block, undo in reversed(disconnected):
+                for t_hash, index in undo.pool_transactions:
+                    if t_hash not in self.confirmed_transactions:
+                        orphan_transactions.append((t_hash, json.loads(block.transactions[index])))
+
+            return self.chain[-1].hash, orphan_transactions, confirmed_hashes
+
+    def __restore_chain(self, fork_height, disconnected):
+        """
+        繋ぎ変えの途中で接続したブロックを切り離し、切り離していた元のブロックを接続し直す
+        """
+        while len(self.chain) > fork_height + 1:
+            self.__remove_tip_block()
+        for block, _ in reversed(disconnected):
+            self.__append_block(block)
@@ -0,0 +1,80 @@
+import hashlib
+import binascii
+
+
+def _get_double_sha256(message):
+    return hashlib.sha256(hashlib.sha256(message).digest()).digest()
+
+
+def get_leaf_hash(transaction_text):
+    return _get_double_sha256(transaction_text.encode('utf-8'))
+
+
+def _next_level(level):
+    # 要素数が奇数の場合は末尾を複製してペアを作る
+    if len(level) % 2 == 1:
+        level = level + [level[-1]]
+    return [_get_double_sha256(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+
+
+def compute_merkle_root(leaves):
+    """
+    リーフのハッシュ値(bytes)のリストからMerkleルートを計算してhex文字列で返却する
+    """
+    if len(leaves) == 0:
+        return binascii.hexlify(bytes(32)).decode('ascii')
+
+    level = list(leaves)
+    while len(level) > 1:
+        level = _next_level(level)
+
+    return binascii.hexlify(level[0]).decode('ascii')
+
+
+def is_mutated_merkle_tree(leaves):
+    """
+    同じ階層で隣り合うペアが等しいノードを含むか確認する。奇数個の末尾を複製する作り方のため、
+    [a, b, c] と [a, b, c, c] のように末尾を重複させた別のリストが同じルートになってしまう(CVE-2012-2459と同じ問題)
+    """
+    level = list(leaves)
+    while len(level) > 1:
+        for i in range(0, len(level) - 1, 2):
+            if level[i] == level[i + 1]:
+                return True
+        level = _next_level(level)
+
+    return False
+
+
+def get_merkle_proof(leaves, index):
+    """
+    index番目のリーフがルートに含まれることを示すための兄弟ノードのリストを返却する
+    要素は(兄弟ノードのハッシュ値のhex文字列, 兄弟ノードが右側にあるか)のタプル
+    """
+    proof = []
+    level = list(leaves)
+    while len(level) > 1:
+        if len(level) % 2 == 1:
+            level = level + [level[-1]]
+        sibling = index ^ 1
+        proof.append((binascii.hexlify(level[sibling]).decode('ascii'), sibling > index))
+        level = _next_level(level)
+        index //= 2
+
+    return proof
+
+
+def verify_merkle_proof(transaction_text, proof, merkle_root):
+    """
+    ブロック全体を持っていなくても、ブロックヘッダのtransactions_rootだけで
+    そのTransactionがブロックに含まれていることを確認できる
+    """
+    current = get_leaf_hash(transaction_text)
+    for sibling_hex, is_right in proof:
+        sibling = binascii.unhexlify(sibling_hex)
+        if is_right:
+            current = _get_double_sha256(current + sibling)
+        else:
+            current = _get_double_sha256(sibling + current)
+
+    return binascii.hexlify(current).decode('ascii') == merkle_root
@@ -0,0 +1,182 @@
+import hashlib
+import queue
+import threading
+import multiprocessing
+
+from time import time
+
+from .block_header import NONCE_FORMAT
+
+
+CHECK_STOP_EVERY = 1000
+# ワーカーの結果を待つ間、この間隔でワーカープロセスが生きているか確認する
+RESULT_POLL_INTERVAL = 1
+
+
+def get_midstate(header_prefix):
+    """
+    ブロックヘッダはnonce以外変化しないので、先頭部分を吸収済みのSHA256オブジェクトを作っておく
+    """
+    return hashlib.sha256(header_prefix)
+
+
+def get_pow_digest(midstate, nonce):
+    h = midstate.copy()
+    h.update(NONCE_FORMAT.pack(nonce))
+    return hashlib.sha256(h.digest()).digest()
+
+
+def _search_nonce(header_prefix, target, start, step, stop_event, result_queue):
+    """
+    start, start + step, start + 2 * step ... の順にnonceを試し、見つかったか他のワーカーから
+    停止を指示されたらnonce(見つからなければNone)と試行回数を返却する
+    """
+    midstate = get_midstate(header_prefix)
+    i = start
+    tried = 0
+    found = None
+    # Eventの確認はプロセス間の同期を伴うので一定回数ごとにまとめて行う
+    while found is None and not stop_event.is_set():
+        for _ in range(CHECK_STOP_EVERY):
+            digest = get_pow_digest(midstate, i)
+            tried += 1
+
+            if int.from_bytes(digest, 'big') <= target:
+                found = i
+                stop_event.set()
+                break
+            i += step
+
+    result_queue.put((found, tried))
+
+
+def _mining_worker(job_queue, stop_event, result_queue):
+    """
+    ノード本体とは別プロセスで動き、ブロックのテンプレートを受け取ってはnonceを探索する
+    (PoW計算がGILを握り続けてネットワーク処理のスレッドを止めないようにするため)
+    """
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        header_prefix, target, start, step = job
+        _search_nonce(header_prefix, target, start, step, stop_event, result_queue)
+
+
+class MiningEngine:
+    """
+    nonceの探索空間をワーカープロセス数で分割して並列にPoWを計算する。
+    ワーカープロセスは最初の計算時に起動し、以降はキュー経由でテンプレートを受け渡して使い回す
+    """
+
+    def __init__(self, workers=None):
+        print('Initializing MiningEngine...')
+        self.workers = workers or multiprocessing.cpu_count()
+        self.last_hash_rate = 0
+        self.ctx = multiprocessing.get_context('spawn')
+        self.processes = []
+        self.job_queues = []
+        self.stop_event = self.ctx.Event()
+        self.result_queue = self.ctx.Queue()
+        # 同時に実行できるPoW計算は1つだけ
+        self.job_lock = threading.Lock()
+        # cancelされるたびに進める世代番号。テンプレート作成前に読んだ世代が古くなっていればジョブを実行しない
+        self.generation = 0
+        self.cancel_lock = threading.Lock()
+
+    def __start_workers(self):
+        print('Starting mining worker processes...', self.workers)
+        for _ in range(self.workers):
+            job_queue = self.ctx.Queue()
+            p = self.ctx.Process(
+                target=_mining_worker,
+                args=(job_queue, self.stop_event, self.result_queue)
+            )
+            p.daemon = True
+            p.start()
+            self.processes.append(p)
+            self.job_queues.append(job_queue)
+
+    def get_generation(self):
+        return self.generation
+
+    def cancel(self):
+        """
+        実行中のPoW計算と、それより前に読んだ世代で開始されようとしているPoW計算を中断させる
+        中断されたcompute_nonceはNoneを返却する
+        """
+        print('Mining job will be cancelled...')
+        with self.cancel_lock:
+            self.generation += 1
+            self.stop_event.set()
+
+    def compute_nonce(self, header_prefix, target, generation=None):
+        """
+        generationにはテンプレートを作る前にget_generationで読んだ値を渡す。テンプレートの作成中に
+        cancelされていた場合は計算を始めずにNoneを返却する
+        """
+        with self.job_lock:
+            if not self.processes:
+                self.__start_workers()
+
+            with self.cancel_lock:
+                if generation is not None and generation != self.generation:
+                    print('Mining job was cancelled before it started...')
+                    return None
+                # 渡された世代より前のcancelはこのジョブとは無関係なので解除してから始める
+                # (確認と解除をcancel_lockの中で行うので、その間のcancelを取りこぼすことはない)
+                self.stop_event.clear()
+            started = time()
+            for w, job_queue in enumerate(self.job_queues):
+                job_queue.put((header_prefix, target, w, self.workers))
+
+            # 全ワーカーから結果を受け取ってから試行回数を集計する
+            nonce = None
+            total_tried = 0
+            received = 0
+            while received < len(self.job_queues):
+                try:
+                    found, tried = self.result_queue.get(timeout=RESULT_POLL_INTERVAL)
+                except queue.Empty:
+                    if all(p.is_alive() for p in self.processes):
+                        continue
+                    # 落ちたワーカーの結果は永遠に届かないので、このジョブは失敗として次回起動し直す
+                    print('Mining worker process died. workers will be restarted...')
+                    self.__restart_workers()
+                    return None
+                received += 1
+                total_tried += tried
+                if found is not None and nonce is None:
+                    nonce = found
+
+            elapsed = time() - started
+            if elapsed > 0:
+                self.last_hash_rate = total_tried / elapsed
+            print('hash rate: {:.0f} hashes/sec ({} workers)'.format(self.last_hash_rate, self.workers))
+
+            return nonce
+
+    def __restart_workers(self):
+        """
+        残っているワーカーを止めて、次のcompute_nonceで新しく起動させる
+        途中まで書き込まれたキューやEventは使い回さずに作り直す
+        """
+        self.stop_event.set()
+        for p in self.processes:
+            p.terminate()
+            p.join()
+        self.processes = []
+        self.job_queues = []
+        self.result_queue = self.ctx.Queue()
+        with self.cancel_lock:
+            self.stop_event = self.ctx.Event()
+
+    def shutdown(self):
+        self.stop_event.set()
+        with self.job_lock:
+            for job_queue in self.job_queues:
+                job_queue.put(None)
+            for p in self.processes:
+                p.join()
+            self.processes = []
+            self.job_queues = []
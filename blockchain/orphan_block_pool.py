@@ -0,0 +1,81 @@
+import threading
+
+from time import time
+
+
+ORPHAN_EXPIRE = 120
+MAX_ORPHAN_BLOCKS = 100
+# 1つのピアが送ってきたorphanブロックで全体を埋められないようにする
+MAX_ORPHAN_BLOCKS_PER_PEER = 20
+
+
+class OrphanBlockPool:
+    """
+    親ブロックがまだ届いていないブロックを、親ブロックのハッシュ値をキーにして一時的に保持する
+    """
+
+    def __init__(self):
+        print('Initializing OrphanBlockPool...')
+        # 親ブロックのハッシュ値 -> [(ブロック, 受信時刻, 送信元のピア), ...]
+        self.blocks_by_parent = {}
+        self.known_hashes = set()
+        # 送信元のピア -> 保持しているそのピアからのorphanブロックの数
+        self.count_by_peer = {}
+        self.lock = threading.Lock()
+
+    def add(self, block, peer=None):
+        with self.lock:
+            self.__remove_expired()
+            if block.hash in self.known_hashes:
+                return False
+            if len(self.known_hashes) >= MAX_ORPHAN_BLOCKS:
+                print('orphan block pool is full...')
+                return False
+            if self.count_by_peer.get(peer, 0) >= MAX_ORPHAN_BLOCKS_PER_PEER:
+                print('too many orphan blocks from the peer...', peer)
+                return False
+
+            print('orphan block is stored: ', block.hash)
+            self.blocks_by_parent.setdefault(block.previous_block, []).append((block, time(), peer))
+            self.known_hashes.add(block.hash)
+            self.count_by_peer[peer] = self.count_by_peer.get(peer, 0) + 1
+            return True
+
+    def has_block(self, block_hash):
+        return block_hash in self.known_hashes
+
+    def pop_children(self, parent_hash):
+        """
+        parent_hashを親に持つブロックを取り出す。親ブロックがチェーンに接続された時に使う
+        """
+        with self.lock:
+            entries = self.blocks_by_parent.pop(parent_hash, [])
+            for block, _, peer in entries:
+                self.__forget(block, peer)
+            return [block for block, _, _ in entries]
+
+    def get_length(self):
+        return len(self.known_hashes)
+
+    def __remove_expired(self):
+        now = time()
+        for parent_hash in list(self.blocks_by_parent):
+            alive = []
+            for block, received, peer in self.blocks_by_parent[parent_hash]:
+                if now - received < ORPHAN_EXPIRE:
+                    alive.append((block, received, peer))
+                else:
+                    print('orphan block is expired: ', block.hash)
+                    self.__forget(block, peer)
+            if alive:
+                self.blocks_by_parent[parent_hash] = alive
+            else:
+                del self.blocks_by_parent[parent_hash]
+
+    def __forget(self, block, peer):
+        self.known_hashes.discard(block.hash)
+        count = self.count_by_peer.get(peer, 0) - 1
+        if count > 0:
+            self.count_by_peer[peer] = count
+        else:
+            self.count_by_peer.pop(peer, None)
@@ -1,17 +1,26 @@
 import socket
-import pickle
+import json
 
 from blockchain.blockchain_manager import BlockchainManager
 from blockchain.block_builder import BlockBuilder
+from blockchain.block import SealedBlock
+from blockchain.block_header import BlockHeader, MAX_TARGET
+from blockchain.merkle_tree import verify_merkle_proof
+from transaction.transactions import get_transaction_hash
 from p2p.connection_manager_4edge import ConnectionManager4Edge
 from p2p.my_protocol_message_store import MessageStore
 from p2p.my_protocol_message_handler import MyProtocolMessageHandler
 from p2p.message_manager import (
     MessageManager,
     MSG_REQUEST_FULL_CHAIN,
-    RSP_FULL_CHAIN,
+    RSP_FULL_CHAIN_CHUNK,
     MSG_ENHANCED,
+    MSG_REQUEST_BLOCKS,
+    RSP_BLOCKS,
+    MSG_REQUEST_TRANSACTION_PROOF,
+    RSP_TRANSACTION_PROOF,
 )
+from core.sync_coordinator import build_blocks_request
 
 
 STATE_INIT = 0
@@ -35,7 +44,11 @@ class ClientCore:
 
         self.bb = BlockBuilder()
         my_genesis_block = self.bb.generate_genesis_block()
-        self.bm = BlockchainManager(my_genesis_block.to_dict())
+        self.bm = BlockchainManager(my_genesis_block.seal())
+        # 受信中のchunkに分割されたチェーンのうち、まだ自分のチェーンより短い分岐部分
+        self.full_chain_branch = []
+        # Merkle証明でブロックへの包含を確認できたTransactionのハッシュ値 -> 含まれるブロックのハッシュ値
+        self.confirmed_transactions = {}
         self.callback = callback
 
     def start(self, my_pubkey=None):
@@ -47,6 +60,7 @@ class ClientCore:
         self.client_state = STATE_SHUTTING_DOWN
         print('Shutdown edge node...')
         self.cm.connection_close()
+        self.bb.shutdown()
 
     def get_my_current_state(self):
         return self.client_state
@@ -57,6 +71,12 @@ class ClientCore:
     def get_my_blockchain(self):
         return self.bm.get_my_blockchain()
 
+    def get_transaction_confirmation(self, transaction_hash):
+        """
+        send_req_transaction_proof_to_my_core_nodeで包含を確認できていれば、含まれるブロックのハッシュ値を返却する
+        """
+        return self.confirmed_transactions.get(transaction_hash)
+
     def __client_api(self, request, message):
         if request == 'pass_message_to_client_application':
             print('Client Core API: pass_message_to_client_application')
@@ -72,23 +92,76 @@ class ClientCore:
             ConnectionManager4Edgeに引き渡すコールバックの中身。
         """
         print(msg)
-        if msg[2] == RSP_FULL_CHAIN:
-            # TODO: ブロックチェーン送信要求に応じて返却されたブロックチェーンを検証する処理を呼び出す
-            new_block_chain = pickle.loads(msg[4].encode('utf8'))
-            result, pool_4_orphan_blocks = self.bm.resolve_conflicts(new_block_chain)
-            print('blockchain received from central', result)
+        if msg[2] == RSP_FULL_CHAIN_CHUNK:
+            # chunkが届くたびに検証し、自分のチェーンより長くなった時点で繋ぎ変える
+            # 自分も持っているブロックは溜めないので、保持するのは分岐した部分だけで済む
+            chunk = json.loads(msg[4])
+            new_blocks = [SealedBlock(b) for b in chunk['blocks']]
+            self.full_chain_branch.extend(b for b in new_blocks if not self.bm.has_block(b.hash))
+            result, _, _ = self.bm.resolve_branch(self.full_chain_branch)
+            print('blockchain chunk received from central', result)
             if result is not None:
                 self.prev_block_hash = result
+                self.full_chain_branch = []
                 print('Calling callback')
                 self.callback()
+
+            if chunk['is_last']:
+                if self.full_chain_branch:
+                    print('Received blockchain is useless...')
+                self.full_chain_branch = []
+        elif msg[2] == RSP_BLOCKS:
+            # 自分のチェーンに続くブロックだけを受け取り、残りがあれば続けて要求する
+            response = json.loads(msg[4])
+            new_blocks = [SealedBlock(b) for b in response['blocks']]
+            result, _, _ = self.bm.resolve_branch(new_blocks)
+            print('blocks received from central', result)
+            if result is not None:
+                self.prev_block_hash = result
+                if response['has_more']:
+                    self.send_req_blocks_to_my_core_node()
+                else:
+                    print('Calling callback')
+                    self.callback()
+            else:
+                print('Received blocks are useless...')
+        elif msg[2] == RSP_TRANSACTION_PROOF:
+            response = json.loads(msg[4])
+            if self.__verify_transaction_proof(response):
+                print('transaction is confirmed in block', response['transaction_id'], response['block_hash'])
+                self.confirmed_transactions[response['transaction_id']] = response['block_hash']
             else:
-                print('Received blockchain is useless...')
+                print('transaction is not confirmed', response['transaction_id'])
         elif msg[2] == MSG_ENHANCED:
             # P2P Network を単なるトランスポートして使っているアプリケーションが独自拡張したメッセージはここで処理する。
             # SimpleBitcoin としてはこの種別は使わない
             self.mpmh.handle_message(msg[4], self.__client_api)
 
 
+    def __verify_transaction_proof(self, response):
+        """
+        コアノードから受け取ったブロックヘッダとMerkle証明だけで、Transactionがそのブロックに含まれていることを確認する
+        """
+        if response['block_hash'] is None:
+            return False
+
+        # ヘッダ自体が偽物でないことはハッシュ値とPoWで確認する
+        header = BlockHeader.deserialize(bytes.fromhex(response['header']))
+        if header.get_hash() != response['block_hash']:
+            print('block header does not match the block hash')
+            return False
+        if header.get_target() > MAX_TARGET or not header.meets_target():
+            print('block header in the proof has invalid PoW')
+            return False
+
+        # 証明されるのはブロック内の文字列なので、それが問い合わせたtxidのTransactionであることも確認する
+        transaction_text = response['transaction']
+        if get_transaction_hash(json.loads(transaction_text)) != response['transaction_id']:
+            print('transaction in the proof does not match the transaction id')
+            return False
+
+        return verify_merkle_proof(transaction_text, response['proof'], header.transactions_root)
+
     def send_message_to_my_core_node(self, msg_type, msg):
         msgtxt = self.cm.get_message_text(msg_type, msg)
         self.cm.send_msg((self.my_core_host, self.my_core_port), msgtxt)
@@ -98,6 +171,25 @@ class ClientCore:
         new_message = self.cm.get_message_text(MSG_REQUEST_FULL_CHAIN)
         self.cm.send_msg((self.my_core_host, self.my_core_port), new_message)
 
+    def send_req_blocks_to_my_core_node(self):
+        """
+        自分のチェーンの最新部分以降のブロックだけを要求する
+        """
+        print('send_req_blocks_to_my_core_node was called')
+        request = build_blocks_request(self.bm.get_block_locator())
+        new_message = self.cm.get_message_text(MSG_REQUEST_BLOCKS, request)
+        self.cm.send_msg((self.my_core_host, self.my_core_port), new_message)
+
+    def send_req_transaction_proof_to_my_core_node(self, transaction_hash):
+        """
+        ブロック全体を受け取らずに、txidのTransactionがブロックに含まれていることをMerkle証明で確認する
+        結果はget_transaction_confirmationで参照する
+        """
+        print('send_req_transaction_proof_to_my_core_node was called')
+        request = json.dumps({'transaction_id': transaction_hash})
+        new_message = self.cm.get_message_text(MSG_REQUEST_TRANSACTION_PROOF, request)
+        self.cm.send_msg((self.my_core_host, self.my_core_port), new_message)
+
     def __get_myip(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.connect(('8.8.8.8', 80))
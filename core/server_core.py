@@ -1,15 +1,18 @@
 import socket
 import threading
 import json
-import pickle
 import time
 import copy
 
 from blockchain.blockchain_manager import BlockchainManager
 from blockchain.block_builder import BlockBuilder
+from blockchain.block import SealedBlock
+from blockchain.block_header import BlockHeader, MAX_TARGET
+from blockchain.orphan_block_pool import OrphanBlockPool
 from transaction.transaction_pool import TransactionPool
 from transaction.utxo_manager import UTXOManager
 from transaction.transactions import CoinbaseTransaction
+from transaction.transactions import get_outpoint, get_transaction_hash
 from utils.key_manager import KeyManager
 from utils.rsa_util import RSAUtil
 from p2p.connection_manager import ConnectionManager
@@ -20,9 +23,22 @@ from p2p.message_manager import (
     MSG_NEW_TRANSACTION,
     MSG_NEW_BLOCK,
     MSG_REQUEST_FULL_CHAIN,
-    RSP_FULL_CHAIN,
+    RSP_FULL_CHAIN_CHUNK,
     MSG_ENHANCED,
+    MSG_REQUEST_BLOCK,
+    RSP_BLOCK,
+    MSG_REQUEST_CHAIN_STATUS,
+    RSP_CHAIN_STATUS,
+    MSG_REQUEST_BLOCKS,
+    RSP_BLOCKS,
+    MSG_REQUEST_HEADERS,
+    RSP_HEADERS,
+    MSG_REQUEST_BLOCK_BODIES,
+    RSP_BLOCK_BODIES,
+    MSG_REQUEST_TRANSACTION_PROOF,
+    RSP_TRANSACTION_PROOF,
 )
+from core.sync_coordinator import SyncCoordinator
 
 
 STATE_INIT = 0
@@ -31,6 +47,8 @@ STATE_CONNECTED_TO_CENTRAL = 2
 STATE_SHUTTING_DOWN = 3
 
 CHECK_INTERVAL = 10
+MAX_BLOCKS_PER_RESPONSE = 50
+MAX_HEADERS_PER_RESPONSE = 500
 
 
 class ServerCore:
@@ -49,10 +67,12 @@ class ServerCore:
         self.bb = BlockBuilder()
         self.flag_stop_block_build = False
         self.is_bb_running = False
-        my_genesis_block = self.bb.generate_genesis_block()
-        self.bm = BlockchainManager(my_genesis_block.to_dict())
-        self.prev_block_hash = self.bm.get_hash(my_genesis_block.to_dict())
+        my_genesis_block = self.bb.generate_genesis_block().seal()
+        self.bm = BlockchainManager(my_genesis_block)
+        self.prev_block_hash = my_genesis_block.hash
         self.tp = TransactionPool()
+        self.orphan_pool = OrphanBlockPool()
+        self.sync = SyncCoordinator(self.cm, self.bm)
 
         self.km = KeyManager(None, passphrase)
         self.rsa_util = RSAUtil()
@@ -76,49 +96,58 @@ class ServerCore:
         self.server_state = STATE_SHUTTING_DOWN
         print('Shutdown server...')
         self.cm.connection_close()
+        self.bb.shutdown()
 
     def get_my_current_state(self):
         return self.server_state
 
     def get_all_chains_for_resolve_conflict(self):
         print('get_all_chains_for_resolve_conflict was called')
-        new_message = self.cm.get_message_text(MSG_REQUEST_FULL_CHAIN)
-        self.cm.send_msg_to_all_peer(new_message)
+        self.sync.request_sync()
 
     def __generate_block_with_tp(self):
         print('Thread for generate_block_with_tp started!')
         while not self.flag_stop_block_build:
             self.is_bb_running = True
+            # prev_block_hashを読む前の世代を控えておき、これ以降の中断要求をPoW開始前でも反映させる
+            generation = self.bb.get_mining_generation()
             prev_hash = copy.copy(self.prev_block_hash)
             result = self.tp.get_stored_transactions()
             if len(result) == 0:
                 print('Transaction Pool is empty...')
                 break
 
-            new_tp = self.bm.remove_useless_transaction(result)
-            self.tp.renew_my_transactions(new_tp)
+            # チェーンに取り込み済みのTransactionはtxidだけで判定して取り除く
+            confirmed_hashes = [h for h in self.tp.get_transaction_hashes() if self.bm.has_transaction(h)]
+            self.tp.remove_transactions(confirmed_hashes)
+            new_tp = self.tp.get_stored_transactions()
             if len(new_tp) == 0:
                 break
 
             # ブロック生成報酬としてリスト先頭に自分宛てのCoinbaseTransactionを追加する
-            total_fee = self.tp.get_total_fee_from_tp()
+            total_fee = self.tp.get_total_fee_from_tp(self.bm.get_output_in_my_chain)
             # TODO: 動作確認のため一時的に固定値を使用する
             total_fee += 30
 
             my_coinbase_t = CoinbaseTransaction(self.km.my_address(), total_fee)
             transactions_4_block = copy.deepcopy(new_tp)
             transactions_4_block.insert(0, my_coinbase_t.to_dict())
-            new_block = self.bb.generate_new_block(transactions_4_block, prev_hash)
+            if self.flag_stop_block_build:
+                break
+            new_block = self.bb.generate_new_block(transactions_4_block, prev_hash, generation)
+            if new_block is None:
+                # 他のノードが先にブロックを生成したので新しいprev_block_hashで作り直す
+                break
 
             # ブロックの追加可否チェック
-            if new_block.to_dict()['previous_block'] == self.prev_block_hash:
-                self.bm.set_new_block(new_block.to_dict())
-                self.prev_block_hash = self.bm.get_hash(new_block.to_dict())
-                msg_new_block = self.cm.get_message_text(MSG_NEW_BLOCK, json.dumps(new_block.to_dict()))
+            new_block = new_block.seal()
+            if new_block.previous_block == self.prev_block_hash:
+                self.bm.set_new_block(new_block)
+                self.prev_block_hash = new_block.hash
+                msg_new_block = self.cm.get_message_text(MSG_NEW_BLOCK, new_block.to_json())
                 self.cm.send_msg_to_all_peer(msg_new_block)
-                # ブロック生成成功時はTransactionPoolをクリアする
-                index = len(new_tp)
-                self.tp.clear_my_transactions(index)
+                # ブロック生成成功時はブロックに含めたTransactionをTransactionPoolから取り除く
+                self.tp.remove_transactions(self.bm.get_transaction_hashes_in_block(new_block))
                 break
             else:
                 print('Bad block. It seems someone already win the PoW.')
@@ -126,9 +155,11 @@ class ServerCore:
 
         print('Current Blockchain is ...', self.bm.chain)
         print('Current prev_block_hash is ...', self.prev_block_hash)
+        # 中断された場合は待たずに最新のブロックを起点として再開する
+        interval = 0 if self.flag_stop_block_build else CHECK_INTERVAL
         self.flag_stop_block_build = False
         self.is_bb_running = False
-        self.bb_timer = threading.Timer(CHECK_INTERVAL, self.__generate_block_with_tp)
+        self.bb_timer = threading.Timer(interval, self.__generate_block_with_tp)
         self.bb_timer.start()
 
     def __core_api(self, request, message):
@@ -157,104 +188,292 @@ class ServerCore:
                 return None
 
     def __handle_message(self, msg, is_core, peer=None):
-        if peer != None:
-            if msg[2] == MSG_REQUEST_FULL_CHAIN:
-                print('Send our latest blockchain for reply to : ', peer)
-                mychain = self.bm.get_my_blockchain()
-                chain_data = pickle.dumps(mychain, 0).decode()
-                new_message = self.cm.get_message_text(RSP_FULL_CHAIN, chain_data)
-                self.cm.send_msg(peer, new_message)
-        else:
-            if msg[2] == MSG_NEW_TRANSACTION:
-                new_transaction = json.loads(msg[4])
-                print('received new_transaction', new_transaction)
-                is_sbc_t, _ = self.um.is_sbc_transaction(new_transaction)
-                current_transactions = self.tp.get_stored_transactions()
-                if new_transaction in current_transactions:
-                    print('this is already pooled transaction: ', new_transaction)
+        if msg[2] == MSG_REQUEST_FULL_CHAIN:
+            print('Send our latest blockchain as chunks for reply to : ', peer)
+            self.cm.send_msg_stream(peer, self.__get_chain_chunk_messages())
+        elif msg[2] == MSG_REQUEST_CHAIN_STATUS:
+            status = {
+                'height': self.bm.get_my_chain_length() - 1,
+                'latest_block': self.bm.get_latest_block_hash(),
+            }
+            new_message = self.cm.get_message_text(RSP_CHAIN_STATUS, json.dumps(status))
+            self.cm.send_msg(peer, new_message)
+        elif msg[2] == RSP_CHAIN_STATUS:
+            if not is_core:
+                print('chain status received from unknown')
+                return
+            self.sync.on_chain_status(peer, json.loads(msg[4]))
+        elif msg[2] == MSG_REQUEST_BLOCK:
+            block = self.bm.get_block_by_hash(msg[4])
+            if block is None:
+                print('requested block is not in my chain: ', msg[4])
+                return
+            print('Send the requested block for reply to : ', peer)
+            new_message = self.cm.get_message_text(RSP_BLOCK, block.to_json())
+            self.cm.send_msg(peer, new_message)
+        elif msg[2] == MSG_NEW_TRANSACTION:
+            new_transaction = json.loads(msg[4])
+            print('received new_transaction', new_transaction)
+            is_sbc_t, _ = self.um.is_sbc_transaction(new_transaction)
+            # 複数のピアから中継されてくるので、txidだけで既知のTransactionかを判定する
+            new_transaction_hash = get_transaction_hash(new_transaction)
+            if self.tp.has_transaction(new_transaction_hash):
+                print('this is already pooled transaction: ', new_transaction_hash)
+                return
+            if self.bm.has_transaction(new_transaction_hash):
+                print('this transaction is already in my blockchain: ', new_transaction_hash)
+                return
+
+            if not is_sbc_t:
+                print('this is not SimpleBitcoin transaction: ', new_transaction)
+                is_verified = self.rsa_util.verify_general_transaction_sig(new_transaction, new_transaction_hash)
+                if not is_verified:
+                    print('Transaction Verification Error')
                     return
-
-                if not is_sbc_t:
-                    print('this is not SimpleBitcoin transaction: ', new_transaction)
-                    is_verified = self.rsa_util.verify_general_transaction_sig(new_transaction)
-                    if not is_verified:
+            else:
+                # テスト用に最初のブロックだけ未知のCoinbaseTransactionを許可する暫定処置
+                if self.bm.get_my_chain_length() != 1:
+                    checked = self._check_availability_of_transaction(new_transaction, new_transaction_hash)
+                    if not checked:
                         print('Transaction Verification Error')
                         return
-                else:
-                    # テスト用に最初のブロックだけ未知のCoinbaseTransactionを許可する暫定処置
-                    if self.bm.get_my_chain_length() != 1:
-                        checked = self._check_availability_of_transaction(new_transaction)
-                        if not checked:
-                            print('Transaction Verification Error')
-                            return
-
-                    self.tp.set_new_transaction(new_transaction)
-
-                if not is_core:
-                    new_message = self.cm.get_message_text(MSG_NEW_TRANSACTION, json.dumps(new_transaction))
-                    self.cm.send_msg_to_all_peer(new_message)
-            elif msg[2] == MSG_NEW_BLOCK:
-                if not is_core:
-                    print('block received from unknown')
-                    return
-
-                # 新規ブロックを検証し正当なものであればブロックチェーンに追加する
-                new_block = json.loads(msg[4])
-                print('new_block: ', new_block)
-                if self.bm.is_valid_block(self.prev_block_hash, new_block):
-                    # ブロック生成中なら処理を止める
-                    if self.is_bb_running:
-                        self.flag_stop_block_build = True
-                    self.prev_block_hash = self.bm.get_hash(new_block)
-                    self.bm.set_new_block(new_block)
-                    new_tp = self.bm.remove_useless_transaction(result)
-                    self.tp.renew_my_transactions(new_tp)
-                else:
-                    # ブロックとして不正ではないがVerifyにコケる場合は自分がorphanブロックを生成している可能性がある
-                    self.get_all_chains_for_resolve_conflict()
-            elif msg[2] == RSP_FULL_CHAIN:
-                if not is_core:
-                    print('blockchain received from unknown')
-                    return
 
-                # ブロックチェーン送信要求に応じて返却されたブロックチェーンを検証し、有効なものか
-                # 検証した上で自分の持つチェーンと比較し優位な方を今後のブロックチェーンとして有効化する
-                new_block_chain = pickle.loads(msg[4].encode('utf8'))
-                print(new_block_chain)
-                result, pool_4_orphan_blocks = self.bm.resolve_conflicts(new_block_chain)
-                print('blockchain received from central')
+                self.tp.set_new_transaction(new_transaction, new_transaction_hash)
+
+            if not is_core:
+                new_message = self.cm.get_message_text(MSG_NEW_TRANSACTION, json.dumps(new_transaction))
+                self.cm.send_msg_to_all_peer(new_message)
+        elif msg[2] == MSG_NEW_BLOCK:
+            if not is_core:
+                print('block received from unknown')
+                return
+
+            new_block = SealedBlock(json.loads(msg[4]))
+            print('new_block: ', new_block)
+            self.__handle_new_block(new_block, peer)
+        elif msg[2] == RSP_BLOCK:
+            if not is_core:
+                print('block received from unknown')
+                return
+
+            # 不足していた祖先ブロックが届いた
+            new_block = SealedBlock(json.loads(msg[4]))
+            print('requested block: ', new_block)
+            self.__handle_new_block(new_block, peer)
+        elif msg[2] == MSG_REQUEST_BLOCKS:
+            request = json.loads(msg[4])
+            max_blocks = min(request['max_blocks'], MAX_BLOCKS_PER_RESPONSE)
+            blocks, has_more = self.bm.get_blocks_after_locator(request['locator'], max_blocks)
+            print('Send {} blocks for reply to : '.format(len(blocks)), peer)
+            response = {
+                'blocks': [b.to_dict() for b in blocks],
+                'has_more': has_more,
+            }
+            new_message = self.cm.get_message_text(RSP_BLOCKS, json.dumps(response))
+            self.cm.send_msg(peer, new_message)
+        elif msg[2] == MSG_REQUEST_HEADERS:
+            request = json.loads(msg[4])
+            max_headers = min(request['max_headers'], MAX_HEADERS_PER_RESPONSE)
+            blocks, has_more = self.bm.get_blocks_after_locator(request['locator'], max_headers)
+            print('Send {} headers for reply to : '.format(len(blocks)), peer)
+            response = {
+                'headers': [b.header_bytes.hex() for b in blocks],
+                'has_more': has_more,
+            }
+            new_message = self.cm.get_message_text(RSP_HEADERS, json.dumps(response))
+            self.cm.send_msg(peer, new_message)
+        elif msg[2] == RSP_HEADERS:
+            if not is_core:
+                print('headers received from unknown')
+                return
+
+            if not self.sync.is_sync_peer(peer):
+                print('headers received from not selected peer', peer)
+                return
+
+            response = json.loads(msg[4])
+            headers = [BlockHeader.deserialize(bytes.fromhex(h)) for h in response['headers']]
+            self.sync.on_headers(peer, headers, response['has_more'])
+        elif msg[2] == MSG_REQUEST_TRANSACTION_PROOF:
+            # ブロック全体の代わりに、ヘッダとMerkle証明だけでTransactionの包含を確認できるようにする
+            request = json.loads(msg[4])
+            transaction_hash = request['transaction_id']
+            block, transaction_text, proof = self.bm.get_transaction_proof(transaction_hash)
+            response = {'transaction_id': transaction_hash, 'block_hash': None}
+            if block is not None:
+                response['block_hash'] = block.hash
+                response['header'] = block.header_bytes.hex()
+                response['transaction'] = transaction_text
+                response['proof'] = proof
+            new_message = self.cm.get_message_text(RSP_TRANSACTION_PROOF, json.dumps(response))
+            self.cm.send_msg(peer, new_message)
+        elif msg[2] == MSG_REQUEST_BLOCK_BODIES:
+            request = json.loads(msg[4])
+            blocks = []
+            for block_hash in request['hashes'][:MAX_BLOCKS_PER_RESPONSE]:
+                block = self.bm.get_block_by_hash(block_hash)
+                if block is not None:
+                    blocks.append(block.to_dict())
+            print('Send {} block bodies for reply to : '.format(len(blocks)), peer)
+            new_message = self.cm.get_message_text(RSP_BLOCK_BODIES, json.dumps({'blocks': blocks}))
+            self.cm.send_msg(peer, new_message)
+        elif msg[2] == RSP_BLOCK_BODIES:
+            if not is_core:
+                print('block bodies received from unknown')
+                return
+
+            if not self.sync.is_body_peer(peer):
+                print('block bodies received from not selected peer', peer)
+                return
+
+            # ヘッダの順に揃ったブロックだけを受け取り、自分のチェーンより長くなった時点で繋ぎ変える
+            response = json.loads(msg[4])
+            branch, is_completed = self.sync.on_block_bodies(peer, response['blocks'])
+            if branch:
+                result, orphan_transactions, confirmed_hashes = self.bm.resolve_branch(
+                    branch, self.__check_block_transactions
+                )
                 if result is not None:
-                    self.prev_block_hash = result
-                    if len(pool_4_orphan_blocks) != 0:
-                        # orphanブロック群の中にあった未処理扱いのTransactionをTransactionPoolに戻す
-                        new_transactions = self.bm.get_transactions_from_orphan_blocks(pool_4_orphan_blocks)
-                        for t in new_transactions:
-                            self.tp.set_new_transaction(t)
-                else:
-                    print('Received blockchain is useless...')
-            elif msg[2] == MSG_ENHANCED:
-                print('received enhanced message', msg[4])
-                has_same = self.mpm_store.has_this_msg(msg[4])
-
-                if not has_same:
-                    self.mpm_store.add(msg[4])
-                    self.mpmh.handle_message(msg[4], self.__core_api, is_core)
-
-    def _check_availability_of_transaction(self, transaction):
+                    self.sync.clear_branch()
+                    self.__on_chain_renewed(result, orphan_transactions, confirmed_hashes, branch)
+
+            if is_completed:
+                self.sync.finish()
+        elif msg[2] == MSG_ENHANCED:
+            print('received enhanced message', msg[4])
+            has_same = self.mpm_store.has_this_msg(msg[4])
+
+            if not has_same:
+                self.mpm_store.add(msg[4])
+                self.mpmh.handle_message(msg[4], self.__core_api, is_core)
+
+    def __get_chain_chunk_messages(self):
+        """
+        エンコード済みのchunkを使い回し、チェーン全体を一度にシリアライズせずにchunkのメッセージを順番に作る
+        送信中に分岐の切り替えで直前に送ったブロックとchunkが繋がらなくなった場合はそこで打ち切る
+        """
+        last_hash = self.bm.get_block_hash_at(0)
+        index = 0
+        while True:
+            entry = self.bm.get_encoded_chain_chunk(index)
+            if entry is None or entry[0] != last_hash:
+                yield self.cm.get_message_text(RSP_FULL_CHAIN_CHUNK, '{"blocks": [], "is_last": true}')
+                return
+
+            _, last_hash, encoded_blocks, has_more = entry
+            chunk = '{"blocks": ' + encoded_blocks + ', "is_last": ' + json.dumps(not has_more) + '}'
+            yield self.cm.get_message_text(RSP_FULL_CHAIN_CHUNK, chunk)
+            if not has_more:
+                return
+            index += 1
+
+    def __on_chain_renewed(self, new_prev_block_hash, orphan_transactions, confirmed_hashes, connected_blocks):
+        # 新しいprev_block_hashを設定してから中断させる(中断後に作られるテンプレートは必ず新しい方を使う)
+        self.prev_block_hash = new_prev_block_hash
+        if self.is_bb_running:
+            self.flag_stop_block_build = True
+        self.bb.stop_block_building()
+        self.tp.remove_transactions(confirmed_hashes)
+        self.__remove_conflicting_transactions(connected_blocks)
+        # orphanブロック群の中にあった未処理扱いのTransactionを、新しいチェーンでも有効なものだけTransactionPoolに戻す
+        # (切り離したブロックのCoinbaseTransactionの出力や、新しいチェーンで使用済みの出力を使うものは戻さない)
+        for t_hash, t in orphan_transactions:
+            is_sbc_t, _ = self.um.is_sbc_transaction(t)
+            if is_sbc_t and not self._check_availability_of_transaction(t, t_hash):
+                print('orphan transaction is no longer available: ', t_hash)
+                continue
+            self.tp.set_new_transaction(t, t_hash)
+        self.__connect_orphan_blocks(new_prev_block_hash)
+
+    def __remove_conflicting_transactions(self, blocks):
+        outpoints = []
+        for block in blocks:
+            outpoints.extend(self.bm.get_spent_outpoints_in_block(block))
+        self.tp.remove_conflicting_transactions(outpoints)
+
+    def __handle_new_block(self, new_block, peer):
+        if self.bm.has_block(new_block.hash) or self.orphan_pool.has_block(new_block.hash):
+            print('this block is already known: ', new_block.hash)
+            return
+
+        if new_block.previous_block == self.prev_block_hash:
+            # 新規ブロックを検証し正当なものであればブロックチェーンに追加する
+            if self.__accept_new_block(new_block):
+                self.__connect_orphan_blocks(new_block.hash)
+        elif self.bm.has_block(new_block.previous_block):
+            # 親ブロックは知っているが最新ではない場合は自分がorphanブロックを生成している可能性がある
+            self.get_all_chains_for_resolve_conflict()
+        else:
+            # 親ブロックより先に届いた場合は一旦保持し、足りない親ブロックだけを要求する
+            # ブロック自身のbitsだけでなくMAX_TARGETとも比べ、PoWのない偽ブロックでorphanブロックの枠を埋められないようにする
+            if new_block.header.get_target() > MAX_TARGET or not new_block.meets_target():
+                print('Invalid block (too easy target or bad nonce)')
+                return
+            if not new_block.has_valid_transactions_root():
+                print('Invalid block (bad transactions_root)')
+                return
+            if self.orphan_pool.add(new_block, peer):
+                self.request_block(new_block.previous_block, peer)
+
+    def __accept_new_block(self, new_block):
+        if not self.bm.is_valid_block(self.prev_block_hash, new_block):
+            return False
+        if not self.__check_block_transactions(new_block):
+            return False
+
+        self.prev_block_hash = new_block.hash
+        # ブロック生成中なら処理を止める(テンプレート作成中でもPoWを始める前に中断される)
+        if self.is_bb_running:
+            self.flag_stop_block_build = True
+        self.bb.stop_block_building()
+        self.bm.set_new_block(new_block)
+        self.tp.remove_transactions(self.bm.get_transaction_hashes_in_block(new_block))
+        self.__remove_conflicting_transactions([new_block])
+        return True
+
+    def __check_block_transactions(self, block):
+        # テスト用に最初のブロックだけ未知のCoinbaseTransactionを許可する暫定処置(MSG_NEW_TRANSACTIONと同じ)
+        if block.previous_block == self.bm.genesis_block.hash:
+            return True
+        return self.check_transactions_in_new_block(block)
+
+    def __connect_orphan_blocks(self, parent_hash):
+        """
+        接続したブロックを親に持つorphanブロックを順番にチェーンへ繋げる
+        """
+        parents = [parent_hash]
+        while parents:
+            for child in self.orphan_pool.pop_children(parents.pop()):
+                if child.previous_block == self.prev_block_hash and self.__accept_new_block(child):
+                    print('orphan block is connected: ', child.hash)
+                    parents.append(child.hash)
+
+    def request_block(self, block_hash, peer=None):
+        print('request_block was called', block_hash)
+        new_message = self.cm.get_message_text(MSG_REQUEST_BLOCK, block_hash)
+        if peer is not None:
+            self.cm.send_msg(peer, new_message)
+        else:
+            self.cm.send_msg_to_all_peer(new_message)
+
+    def _check_availability_of_transaction(self, transaction, transaction_hash=None):
         """
         Transactionに含まれているTransactionInputの有効性(二重使用)を検証する
         """
-        v_result, used_outputs = self.rsa_util.verify_sbc_transactions_sig(transaction)
+        v_result, used_outputs = self.rsa_util.verify_sbc_transactions_sig(
+            transaction, self.bm.get_output_in_my_chain, transaction_hash
+        )
 
         if v_result is not True:
             print('signature verification error on new transaction')
             return False
 
-        for used_o in used_ouputs:
+        for txin, used_o in zip(transaction['inputs'], used_outputs):
             print('used_o', used_o)
-            bm_v_result = self.bm.has_this_output_in_my_chain(used_o)
-            tp_v_result = self.tp.has_this_output_in_my_tp(used_o)
-            bm_v_result2 = self.bm.is_valid_output_in_my_chain(used_o)
+            outpoint = get_outpoint(txin)
+            bm_v_result = self.bm.has_this_output_in_my_chain(outpoint)
+            tp_v_result = self.tp.has_this_output_in_my_tp(txin)
+            bm_v_result2 = self.bm.is_valid_output_in_my_chain(outpoint)
             if bm_v_result:
                 print('This TransactionOutput is already used', used_o)
                 return False
@@ -267,16 +486,20 @@ class ServerCore:
 
         return True
 
-    def _check_availability_of_transaction_in_block(self, transaction):
-        v_result, used_outputs = self.km.verify_sbc_transactions_sig(transaction)
+    def _check_availability_of_transaction_in_block(self, transaction, transaction_hash=None):
+        # TransactionPoolへの受け入れ時に検証済みの署名はRSAUtilのキャッシュで省略される
+        v_result, used_outputs = self.rsa_util.verify_sbc_transactions_sig(
+            transaction, self.bm.get_output_in_my_chain, transaction_hash
+        )
         if v_result is not True:
             print('signature verification error on new transaction')
             return False
 
-        for used_o in used_outputs:
+        for txin, used_o in zip(transaction['inputs'], used_outputs):
             print('used_o: ', used_o)
-            bm_v_result = self.bm.has_this_output_in_my_chain(used_o)
-            bm_v_result2 = self.bm.is_valid_output_in_my_chain(used_o)
+            outpoint = get_outpoint(txin)
+            bm_v_result = self.bm.has_this_output_in_my_chain(outpoint)
+            bm_v_result2 = self.bm.is_valid_output_in_my_chain(outpoint)
             if bm_v_result2 is not True:
                 print('This TransactionOutput is unknown', used_o)
                 return False
@@ -288,13 +511,17 @@ class ServerCore:
 
     def get_total_fee_on_block(self, block):
         print('get_total_fee_on_block was called')
-        transactions = block['transactions']
+        # 検証と接続で使い回す解析結果を共有する
+        transactions = block.parse_transactions()
         result = 0
         for t in transactions:
-            t = json.loads(t)
             is_sbc_t, t_type = self.um.is_sbc_transaction(t)
             if t_type == 'basic':
-                total_in = sum(i['transaction']['outputs'][i['output_index']]['value'] for i in t['inputs'])
+                total_in = 0
+                for i in t['inputs']:
+                    txout = self.bm.get_output_in_my_chain(get_outpoint(i))
+                    if txout is not None:
+                        total_in += txout.value
                 total_out = sum(o['value'] for o in t['outputs'])
                 delta = total_in - total_out
                 result += delta
@@ -309,17 +536,16 @@ class ServerCore:
         fee_for_block += 30 # FIXME: 一旦固定値にしておく
         print('fee_for_block: ', fee_for_block)
 
-        transactions = block['transactions']
+        transactions = block.parse_transactions()
 
         counter = 0
 
-        for t in transactions:
-            t = json.loads(t)
+        for t_hash, t in zip(block.transaction_ids, transactions):
             # basic, coinbase_transaction以外はスルー
             is_sbc_t, t_type = self.um.is_sbc_transaction(t)
             if is_sbc_t:
                 if t_type == 'basic':
-                    if self._check_availability_of_transaction_in_block(t) is not True:
+                    if self._check_availability_of_transaction_in_block(t, t_hash) is not True:
                         print('Bad Block. Having invalid Transaction')
                         return False
                 elif t_type == 'coinbase_transaction':
@@ -333,9 +559,10 @@ class ServerCore:
                             print('Invalid value in fee for CoinbaseTransaction', insentive)
                             return False
             else:
-                is_verified = self.rsa_util.verify_general_transaction_sig(t)
+                is_verified = self.rsa_util.verify_general_transaction_sig(t, t_hash)
                 if not is_verified:
                     return False
+            counter += 1
 
         print('ok. this block is acceptable')
         return True
@@ -0,0 +1,343 @@
+import json
+import threading
+
+from time import time
+
+from blockchain.block import SealedBlock
+from p2p.message_manager import (
+    MSG_REQUEST_CHAIN_STATUS,
+    MSG_REQUEST_HEADERS,
+    MSG_REQUEST_BLOCK_BODIES,
+)
+
+
+SYNC_IDLE = 0
+SYNC_COLLECTING_STATUS = 1
+SYNC_HEADERS = 2
+SYNC_BODIES = 3
+
+STATUS_WAIT = 2
+SYNC_TIMEOUT = 30
+BLOCKS_PER_REQUEST = 50
+HEADERS_PER_REQUEST = 500
+# 1回の要求で1つのピアに取りに行くブロック本体の数
+BODY_WINDOW = 16
+# 1つのピアに同時に割り当てるwindowの数
+WINDOWS_PER_PEER = 2
+BODY_TIMEOUT = 10
+# この回数だけ応答がタイムアウトしたピアは、遅いだけではなく使えないものとして扱う
+MAX_BODY_TIMEOUTS = 3
+
+
+def build_blocks_request(locator, max_blocks=BLOCKS_PER_REQUEST):
+    request = {
+        'locator': locator,
+        'max_blocks': max_blocks,
+    }
+    return json.dumps(request)
+
+
+def build_headers_request(locator, max_headers=HEADERS_PER_REQUEST):
+    request = {
+        'locator': locator,
+        'max_headers': max_headers,
+    }
+    return json.dumps(request)
+
+
+class SyncCoordinator:
+    """
+    ブロックチェーンの同期を同時に1つだけ実行する。同期中の要求はまとめて1回にする
+    各ピアが通知してきたチェーンの高さを比べて一番長いピアからブロックヘッダだけを先に受け取って検証し、
+    ブロック本体はそのヘッダに一致するものを複数のピアからwindow単位で並行して受け取る
+    応答が遅いピアや不正なブロックを返すピアに割り当てたwindowは他のピアに割り当て直す
+    """
+
+    def __init__(self, cm, bm):
+        print('Initializing SyncCoordinator...')
+        self.cm = cm
+        self.bm = bm
+        self.state = SYNC_IDLE
+        self.peer_heights = {}
+        self.sync_peer = None
+        self.has_pending_request = False
+        # 検証済みのヘッダ [(ブロックのハッシュ値, BlockHeader), ...] と分岐点の高さ
+        self.headers = []
+        self.header_index = {}
+        self.fork_height = 0
+        # ブロック本体の取得状況
+        self.body_peers = []
+        self.slow_peers = set()
+        self.bad_peers = set()
+        self.body_timeouts = {}
+        # 最後にブロック本体の取得が進んだ時刻。SYNC_TIMEOUTの間進まなければ同期をやめる
+        self.last_progress = 0
+        self.pending_windows = []
+        # windowの先頭ハッシュ値 -> (ピア, ハッシュ値のリスト, 要求した時刻)
+        self.in_flight = {}
+        self.bodies = {}
+        self.next_index = 0
+        # 自分のチェーンより長くなるまで受け取ったブロックを溜めておく
+        self.branch = []
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def request_sync(self):
+        with self.lock:
+            if self.state != SYNC_IDLE:
+                print('sync is already in progress. the request is collapsed into it')
+                self.has_pending_request = True
+                return
+
+            print('start collecting chain status from peers...')
+            self.state = SYNC_COLLECTING_STATUS
+            self.peer_heights = {}
+            self.has_pending_request = False
+            self.__start_timer(STATUS_WAIT, self.__select_sync_peer)
+
+        new_message = self.cm.get_message_text(MSG_REQUEST_CHAIN_STATUS)
+        self.cm.send_msg_to_all_peer(new_message)
+
+    def on_chain_status(self, peer, status):
+        with self.lock:
+            if self.state == SYNC_COLLECTING_STATUS:
+                print('chain status received from', peer, status)
+                self.peer_heights[peer] = status['height']
+
+    def is_sync_peer(self, peer):
+        with self.lock:
+            return self.state == SYNC_HEADERS and peer == self.sync_peer
+
+    def is_body_peer(self, peer):
+        with self.lock:
+            return self.state == SYNC_BODIES and peer in self.body_peers
+
+    def on_headers(self, peer, headers, has_more):
+        """
+        同期相手から届いたヘッダを前のヘッダとの繋がりとPoWだけで検証して溜めていく
+        """
+        with self.lock:
+            if self.state != SYNC_HEADERS or peer != self.sync_peer:
+                return
+
+            for header in headers:
+                if self.headers:
+                    prev_hash = self.headers[-1][0]
+                elif self.bm.has_block(header.previous_block):
+                    prev_hash = header.previous_block
+                    self.fork_height = self.bm.get_block_height(prev_hash)
+                else:
+                    print('headers do not connect to my chain')
+                    self.__start_timer(0, self.__on_timeout)
+                    return
+                if not self.bm.is_valid_header(prev_hash, header):
+                    print('invalid header received from', peer)
+                    self.__start_timer(0, self.__on_timeout)
+                    return
+                self.headers.append((header.get_hash(), header))
+
+            if has_more and len(headers) > 0:
+                self.__start_timer(SYNC_TIMEOUT, self.__on_timeout)
+                new_message = self.cm.get_message_text(
+                    MSG_REQUEST_HEADERS, build_headers_request([self.headers[-1][0]])
+                )
+                requests = [(peer, new_message)]
+            else:
+                requests = self.__start_downloading_bodies()
+
+        self.__send_requests(requests)
+
+    def on_block_bodies(self, peer, blocks):
+        """
+        受け取ったブロック本体をヘッダと照合し、先頭から隙間なく揃った分をbranchに繋げて返却する
+        2つ目の戻り値は全てのブロック本体を受け取り終えたかどうか
+        """
+        with self.lock:
+            if self.state != SYNC_BODIES:
+                return [], False
+
+            for block_dict in blocks:
+                block = SealedBlock(block_dict)
+                index = self.header_index.get(block.hash)
+                if index is None or not block.has_valid_transactions_root():
+                    print('invalid block body received from', peer)
+                    self.bad_peers.add(peer)
+                    break
+                if index >= self.next_index:
+                    self.bodies[block.hash] = block
+
+            for key, (p, hashes, _) in list(self.in_flight.items()):
+                if p != peer:
+                    continue
+                if peer in self.bad_peers or all(h in self.bodies for h in hashes):
+                    del self.in_flight[key]
+                    missing = [h for h in hashes if h not in self.bodies]
+                    if missing:
+                        self.pending_windows.insert(0, missing)
+
+            while self.next_index < len(self.headers):
+                block_hash = self.headers[self.next_index][0]
+                if block_hash not in self.bodies:
+                    break
+                self.branch.append(self.bodies.pop(block_hash))
+                self.next_index += 1
+                self.last_progress = time()
+
+            is_completed = self.next_index == len(self.headers)
+            requests = [] if is_completed else self.__dispatch_windows()
+            branch = list(self.branch)
+
+        self.__send_requests(requests)
+        return branch, is_completed
+
+    def clear_branch(self):
+        with self.lock:
+            self.branch = []
+
+    def finish(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.state = SYNC_IDLE
+            self.sync_peer = None
+            self.headers = []
+            self.header_index = {}
+            self.pending_windows = []
+            self.in_flight = {}
+            self.bodies = {}
+            self.branch = []
+            has_pending_request = self.has_pending_request
+
+        # 同期中に届いた要求は1回にまとめて再実行する
+        if has_pending_request:
+            self.request_sync()
+
+    def __select_sync_peer(self):
+        with self.lock:
+            my_height = self.bm.get_my_chain_length() - 1
+            candidates = [(h, p) for p, h in self.peer_heights.items() if h > my_height]
+            if not candidates:
+                print('no peer has longer chain than mine...')
+                self.state = SYNC_IDLE
+                self.sync_peer = None
+                self.has_pending_request = False
+                return
+
+            _, self.sync_peer = max(candidates)
+            self.state = SYNC_HEADERS
+            self.headers = []
+            self.header_index = {}
+            self.branch = []
+            self.__start_timer(SYNC_TIMEOUT, self.__on_timeout)
+            sync_peer = self.sync_peer
+
+        print('block headers will be downloaded from', sync_peer)
+        new_message = self.cm.get_message_text(
+            MSG_REQUEST_HEADERS, build_headers_request(self.bm.get_block_locator())
+        )
+        self.cm.send_msg(sync_peer, new_message)
+
+    def __start_downloading_bodies(self):
+        my_height = self.bm.get_my_chain_length() - 1
+        target_height = self.fork_height + len(self.headers)
+        if target_height <= my_height:
+            print('received headers are not longer than my chain...')
+            self.__start_timer(0, self.__on_timeout)
+            return []
+
+        print('{} headers are verified. start downloading block bodies...'.format(len(self.headers)))
+        # ヘッダの最後までのブロックを持っていると通知してきたピア全てから本体を受け取る
+        self.body_peers = [p for p, h in self.peer_heights.items() if h >= target_height]
+        if self.sync_peer not in self.body_peers:
+            self.body_peers.append(self.sync_peer)
+        self.slow_peers = set()
+        self.bad_peers = set()
+        self.body_timeouts = {}
+        self.last_progress = time()
+        self.header_index = {h: i for i, (h, _) in enumerate(self.headers)}
+        hashes = [h for h, _ in self.headers]
+        self.pending_windows = [hashes[i:i + BODY_WINDOW] for i in range(0, len(hashes), BODY_WINDOW)]
+        self.in_flight = {}
+        self.bodies = {}
+        self.next_index = 0
+        self.state = SYNC_BODIES
+        self.__start_timer(BODY_TIMEOUT / 2, self.__check_slow_peers)
+        return self.__dispatch_windows()
+
+    def __dispatch_windows(self):
+        """
+        空いているピアに未割り当てのwindowを割り当て、送信すべき(ピア, メッセージ)のリストを返却する
+        遅いピアは他に空いているピアがない場合にだけ使う
+        """
+        peers = [p for p in self.body_peers if p not in self.bad_peers]
+        fast_peers = [p for p in peers if p not in self.slow_peers]
+        if fast_peers:
+            peers = fast_peers
+
+        requests = []
+        for peer in peers:
+            assigned = sum(1 for p, _, _ in self.in_flight.values() if p == peer)
+            while self.pending_windows and assigned < WINDOWS_PER_PEER:
+                hashes = self.pending_windows.pop(0)
+                self.in_flight[hashes[0]] = (peer, hashes, time())
+                payload = json.dumps({'hashes': hashes})
+                requests.append((peer, self.cm.get_message_text(MSG_REQUEST_BLOCK_BODIES, payload)))
+                assigned += 1
+
+        return requests
+
+    def __check_slow_peers(self):
+        with self.lock:
+            if self.state != SYNC_BODIES:
+                return
+
+            now = time()
+            if now - self.last_progress > SYNC_TIMEOUT:
+                print('block bodies download made no progress...')
+                self.__start_timer(0, self.__on_timeout)
+                return
+
+            for key, (peer, hashes, requested) in list(self.in_flight.items()):
+                if now - requested > BODY_TIMEOUT:
+                    print('block bodies request timed out. reassign to other peer', peer)
+                    self.slow_peers.add(peer)
+                    self.body_timeouts[peer] = self.body_timeouts.get(peer, 0) + 1
+                    if self.body_timeouts[peer] >= MAX_BODY_TIMEOUTS:
+                        print('peer does not respond to block bodies requests', peer)
+                        self.bad_peers.add(peer)
+                    self.__requeue_window(key)
+
+            # 使えなくなったピアに割り当てたままのwindowも他のピアに割り当て直す
+            for key, (peer, _, _) in list(self.in_flight.items()):
+                if peer in self.bad_peers:
+                    self.__requeue_window(key)
+
+            if all(p in self.bad_peers for p in self.body_peers):
+                print('no peer is available for block bodies...')
+                self.__start_timer(0, self.__on_timeout)
+                return
+
+            requests = self.__dispatch_windows()
+            self.__start_timer(BODY_TIMEOUT / 2, self.__check_slow_peers)
+
+        self.__send_requests(requests)
+
+    def __requeue_window(self, key):
+        _, hashes, _ = self.in_flight.pop(key)
+        missing = [h for h in hashes if h not in self.bodies]
+        if missing:
+            self.pending_windows.insert(0, missing)
+
+    def __send_requests(self, requests):
+        for peer, new_message in requests:
+            self.cm.send_msg(peer, new_message)
+
+    def __on_timeout(self):
+        print('sync timed out with', self.sync_peer)
+        self.finish()
+
+    def __start_timer(self, interval, function):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = threading.Timer(interval, function)
+        self.timer.start()
@@ -15,6 +15,8 @@ from .message_manager import (
     MSG_PING,
     MSG_ADD_AS_EDGE,
     MSG_REMOVE_EDGE,
+    MESSAGE_DELIMITER,
+    read_messages,
 
     ERR_PROTOCOL_UNMATCH,
     ERR_VERSION_UNMATCH,
@@ -88,6 +90,21 @@ class ConnectionManager:
             print('Connection failed for peer : ', peer)
             self.__remove_peer(peer)
 
+    def send_msg_stream(self, peer, msgs):
+        """
+        複数のメッセージを1つの接続で順番に送信する。msgsはイテレータでよく、
+        送信側でも一度に全てのメッセージを作ってメモリに載せることはない
+        """
+        try:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.connect((peer))
+            for msg in msgs:
+                s.sendall(msg.encode('utf-8') + MESSAGE_DELIMITER)
+            s.close()
+        except OSError:
+            print('Connection failed for peer : ', peer)
+            self.__remove_peer(peer)
+
     # Coreノードリストの全てのピアへメッセージをブロードキャストする
     def send_msg_to_all_peer(self, msg):
         print('send_msg_to_all_peer was called!')
@@ -124,19 +141,13 @@ class ConnectionManager:
         return self.core_node_set.has_this_peer(peer)
 
     def __handle_message(self, params):
-        
-        soc, addr, data_sum = params
+        soc, addr, _ = params
 
-        while True:
-            data = soc.recv(1024)
-            data_sum = data_sum + data.decode('utf-8')
-
-            if not data:
-                break
-
-        if not data_sum:
-            return
+        # chunkに分割されたチェーンなど、1つの接続で届く複数のメッセージは受信した順に処理する
+        for msg_text in read_messages(soc):
+            self.__handle_message_text(msg_text, addr)
 
+    def __handle_message_text(self, data_sum, addr):
         result, reason, cmd, peer_port, payload = self.mm.parse(data_sum)
         print(result, reason, cmd, peer_port, payload)
         status = (result, reason)
@@ -217,7 +228,7 @@ class ConnectionManager:
                 self.send_msg((addr[0], peer_port), msg)
             else:
                 is_core = self.__is_in_core_set((addr[0], peer_port))
-                self.callback((result, reason, cmd, peer_port, payload), is_core, None)
+                self.callback((result, reason, cmd, peer_port, payload), is_core, (addr[0], peer_port))
         else:
             print('Unexpected status', status)
 
@@ -10,6 +10,7 @@ from .message_manager import (
     MSG_CORE_LIST,
     MSG_PING,
     MSG_ADD_AS_EDGE,
+    read_messages,
     ERR_PROTOCOL_UNMATCH,
     ERR_VERSION_UNMATCH,
     OK_WITH_PAYLOAD,
@@ -96,18 +97,13 @@ class ConnectionManager4Edge(object):
             executor.submit(self.__handle_message, params)
 
     def __handle_message(self, params):
-       soc, addr, data_sum = params
-       
-       while True:
-           data = soc.recv(1024)
-           data_sum = data_sum + data.decode('utf-8')
+       soc, addr, _ = params
 
-           if not data:
-               break
-
-       if not data_sum:
-           return
+       # chunkに分割されたチェーンなど、1つの接続で届く複数のメッセージは受信した順に処理する
+       for msg_text in read_messages(soc):
+           self.__handle_message_text(msg_text)
 
+    def __handle_message_text(self, data_sum):
        result, reason, cmd, peer_port, payload = self.mm.parse(data_sum)
        print(result, reason, cmd, peer_port, payload)
        status = (result, reason)
@@ -16,12 +16,53 @@ MSG_NEW_BLOCK = 8
 MSG_REQUEST_FULL_CHAIN = 9
 RSP_FULL_CHAIN = 10
 MSG_ENHANCED = 11
+MSG_REQUEST_BLOCK = 12
+RSP_BLOCK = 13
+MSG_REQUEST_CHAIN_STATUS = 14
+RSP_CHAIN_STATUS = 15
+MSG_REQUEST_BLOCKS = 16
+RSP_BLOCKS = 17
+MSG_REQUEST_HEADERS = 18
+RSP_HEADERS = 19
+MSG_REQUEST_BLOCK_BODIES = 20
+RSP_BLOCK_BODIES = 21
+RSP_FULL_CHAIN_CHUNK = 22
+MSG_REQUEST_TRANSACTION_PROOF = 23
+RSP_TRANSACTION_PROOF = 24
 
 ERR_PROTOCOL_UNMATCH = 0
 ERR_VERSION_UNMATCH = 1
 OK_WITH_PAYLOAD = 2
 OK_WITHOUT_PAYLOAD = 3
 
+RECV_BUFFER_SIZE = 1024
+# 1つの接続で複数のメッセージを続けて送る場合の区切り(json.dumpsの出力は改行を含まない)
+MESSAGE_DELIMITER = b'\n'
+
+
+def read_messages(soc):
+    """
+    ソケットから受信したデータを区切り文字ごとに1メッセージずつ返却する
+    受信済みのデータは1メッセージ分だけ保持し、接続が閉じられる前でも届いた順に処理できる
+    """
+    buffer = []
+    while True:
+        data = soc.recv(RECV_BUFFER_SIZE)
+        if not data:
+            break
+
+        parts = data.split(MESSAGE_DELIMITER)
+        buffer.append(parts[0])
+        for part in parts[1:]:
+            msg_text = b''.join(buffer)
+            buffer = [part]
+            if msg_text:
+                yield msg_text.decode('utf-8')
+
+    msg_text = b''.join(buffer)
+    if msg_text:
+        yield msg_text.decode('utf-8')
+
 
 class MessageManager:
     def __init__(self):
@@ -52,7 +93,10 @@ class MessageManager:
             return ('error', ERR_PROTOCOL_UNMATCH, None, None)
         elif msg_ver > StrictVersion(MY_VERSION):
             return ('error', ERR_VERSION_UNMATCH, None, None)
-        elif cmd in (MSG_CORE_LIST, MSG_NEW_TRANSACTION, MSG_NEW_BLOCK, RSP_FULL_CHAIN, MSG_ENHANCED, MSG_ADD_AS_EDGE):
+        elif cmd in (MSG_CORE_LIST, MSG_NEW_TRANSACTION, MSG_NEW_BLOCK, RSP_FULL_CHAIN, MSG_ENHANCED, MSG_ADD_AS_EDGE,
+                     MSG_REQUEST_BLOCK, RSP_BLOCK, RSP_CHAIN_STATUS, MSG_REQUEST_BLOCKS, RSP_BLOCKS,
+                     MSG_REQUEST_HEADERS, RSP_HEADERS, MSG_REQUEST_BLOCK_BODIES, RSP_BLOCK_BODIES,
+                     RSP_FULL_CHAIN_CHUNK, MSG_REQUEST_TRANSACTION_PROOF, RSP_TRANSACTION_PROOF):
             result_type = OK_WITH_PAYLOAD
             return ('ok', result_type, cmd, my_port, payload)
         else:
@@ -1,39 +1,37 @@
 from blockchain.blockchain_manager import BlockchainManager
 from blockchain.block_builder import BlockBuilder
+from transaction.transactions import Transaction, TransactionOutput
 
 
 def main():
     bb = BlockBuilder()
-    my_genesis_block = bb.generate_genesis_block()
-    bm = BlockchainManager(my_genesis_block.to_dict())
+    my_genesis_block = bb.generate_genesis_block().seal()
+    bm = BlockchainManager(my_genesis_block)
 
-    prev_block_hash = bm.get_hash(my_genesis_block.to_dict())
+    prev_block_hash = my_genesis_block.hash
     print('genesis_block_hash :', prev_block_hash)
 
-    transaction = {
-        'sender': 'test1',
-        'recipient': 'test2',
-        'value': 3
-    }
+    transaction = Transaction([], [TransactionOutput('test2', 3)]).to_dict()
 
-    new_block = bb.generate_new_block(transaction, prev_block_hash)
-    bm.set_new_block(new_block.to_dict())
+    new_block = bb.generate_new_block([transaction], prev_block_hash)
+    if new_block is None:
+        bb.shutdown()
+        return
+    new_block = new_block.seal()
+    bm.set_new_block(new_block)
 
-    new_block_hash = bm.get_hash(new_block.to_dict())
+    new_block_hash = new_block.hash
     print('1st_block_hash :', new_block_hash)
 
-    transaction2 = {
-        'sender': 'test1',
-        'recipient': 'test3',
-        'value': 2
-    }
+    transaction2 = Transaction([], [TransactionOutput('test3', 2)]).to_dict()
 
-    new_block2 = bb.generate_new_block(transaction2, new_block_hash)
-    bm.set_new_block(new_block2.to_dict())
+    new_block2 = bb.generate_new_block([transaction2], new_block_hash)
+    if new_block2 is not None:
+        bm.set_new_block(new_block2.seal())
 
-    print(bm.chain)
-    chain = bm.chain
-    print(bm.is_valid(chain))
+    print(bm.get_my_blockchain())
+    print(bm.is_valid_chain(bm.chain))
+    bb.shutdown()
 
 
 if __name__ == '__main__':
@@ -5,6 +5,7 @@ from time import sleep
 
 from blockchain.blockchain_manager import BlockchainManager
 from blockchain.block_builder import BlockBuilder
+from transaction.transactions import Transaction, TransactionOutput
 from transaction.transaction_pool import TransactionPool
 
 
@@ -18,12 +19,14 @@ def generate_block_with_tp(tp, bb, bm, prev_block_hash):
         print('Transaction Pool is empty...')
 
     new_block = bb.generate_new_block(result, prev_block_hash)
-    bm.set_new_block(new_block.to_dict())
-    prev_block_hash = bm.get_hash(new_block.to_dict())
-    index = len(result)
-    tp.clear_my_transactions(index)
-
-    print('Current Blockchain is ...', bm.chain)
+    if new_block is not None:
+        new_block = new_block.seal()
+        bm.set_new_block(new_block)
+        prev_block_hash = new_block.hash
+        index = len(result)
+        tp.clear_my_transactions(index)
+
+    print('Current Blockchain is ...', bm.get_my_blockchain())
     print('Current prev_block_hash is ...', prev_block_hash)
 
     block_timer = threading.Timer(CHECK_INTERVAL, generate_block_with_tp, args=(tp, bb, bm, prev_block_hash))
@@ -32,27 +35,19 @@ def generate_block_with_tp(tp, bb, bm, prev_block_hash):
 
 def main():
     bb = BlockBuilder()
-    my_genesis_block = bb.generate_genesis_block()
-    bm = BlockchainManager(my_genesis_block.to_dict())
+    my_genesis_block = bb.generate_genesis_block().seal()
+    bm = BlockchainManager(my_genesis_block)
 
     tp = TransactionPool()
 
-    prev_block_hash = bm.get_hash(my_genesis_block.to_dict())
+    prev_block_hash = my_genesis_block.hash
     print('genesis_block_hash: ', prev_block_hash)
 
-    transaction = {
-        'sender': 'test1',
-        'recipient': 'test2',
-        'value': 3
-    }
+    transaction = Transaction([], [TransactionOutput('test2', 3)]).to_dict()
 
     tp.set_new_transaction(transaction)
 
-    transaction2 = {
-        'sender': 'test1',
-        'recipient': 'test3',
-        'value': 2
-    }
+    transaction2 = Transaction([], [TransactionOutput('test3', 2)]).to_dict()
 
     tp.set_new_transaction(transaction2)
 
@@ -61,11 +56,7 @@ def main():
 
     sleep(10)
 
-    transaction3 = {
-        'sender': 'test5',
-        'recipient': 'test6',
-        'value': 10
-    }
+    transaction3 = Transaction([], [TransactionOutput('test6', 10)]).to_dict()
 
     tp.set_new_transaction(transaction)
 
@@ -4,6 +4,7 @@ from time import sleep
 
 from blockchain.blockchain_manager import BlockchainManager
 from blockchain.block_builder import BlockBuilder
+from transaction.transactions import Transaction, TransactionOutput
 from transaction.transaction_pool import TransactionPool
 
 # TransactionPoolの確認頻度
@@ -27,14 +28,16 @@ def generate_block_with_tp(tp, bb, bm, prev_block_hash):
             result = tp.get_stored_transactions()
             if result != None:
                 new_block = bb.generate_new_block(result, prev_block_hash)
-                bm.set_new_block(new_block.to_dict())
-                prev_block_hash = bm.get_hash(new_block.to_dict())
-                # ブロック生成に成功したらTransaction Poolはクリアする
-                index = len(result)
-                tp.clear_my_transactions(index)
+                if new_block is not None:
+                    new_block = new_block.seal()
+                    bm.set_new_block(new_block)
+                    prev_block_hash = new_block.hash
+                    # ブロック生成に成功したらTransaction Poolはクリアする
+                    index = len(result)
+                    tp.clear_my_transactions(index)
             else:
                 print('Transaction Pool is empty ...') 
-            print('Current Blockchain is ... ', bm.chain)
+            print('Current Blockchain is ... ', bm.get_my_blockchain())
             print('Current prev_block_hash is ... ', prev_block_hash)
             t=time.time()
 
@@ -46,27 +49,19 @@ def main():
     global FLAG_STOP_BLOCK_BUILD
 
     bb = BlockBuilder()
-    my_genesis_block = bb.generate_genesis_block()
-    bm = BlockchainManager(my_genesis_block.to_dict())
+    my_genesis_block = bb.generate_genesis_block().seal()
+    bm = BlockchainManager(my_genesis_block)
     
     tp = TransactionPool()
 
-    prev_block_hash = bm.get_hash(my_genesis_block.to_dict())
+    prev_block_hash = my_genesis_block.hash
     print('genesis_block_hash :' , prev_block_hash)
 
-    transaction = { 
-        'sender': 'test1',
-        'recipient': 'test2',
-        'value' : 3
-    }
+    transaction = Transaction([], [TransactionOutput('test2', 3)]).to_dict()
     
     tp.set_new_transaction(transaction)
 
-    transaction2 = { 
-        'sender': 'test1',
-        'recipient': 'test3',
-        'value' : 2
-    }
+    transaction2 = Transaction([], [TransactionOutput('test3', 2)]).to_dict()
     
     tp.set_new_transaction(transaction2)
     
@@ -74,11 +69,7 @@ def main():
 
     sleep(20)
 
-    transaction3 = { 
-        'sender': 'test5',
-        'recipient': 'test6',
-        'value' : 10
-    }
+    transaction3 = Transaction([], [TransactionOutput('test6', 10)]).to_dict()
     
     tp.set_new_transaction(transaction3)
 
@@ -0,0 +1,36 @@
+import json
+
+from blockchain.block import Block, SealedBlock
+from blockchain.block_header import MAX_TARGET_BITS, compute_transactions_root
+from blockchain.merkle_tree import get_leaf_hash, is_mutated_merkle_tree
+
+
+def build_transactions(tx_count):
+    return [{'inputs': [], 'outputs': [{'recipient': 'pubkey_{}'.format(i), 'value': 30}], 't_type': 'basic'}
+            for i in range(tx_count)]
+
+
+def main():
+    texts = [json.dumps(t) for t in build_transactions(3)]
+    duplicated = texts + [texts[-1]]
+
+    # 末尾を重複させたリストは同じルートになってしまう
+    print('same root: ', compute_transactions_root(texts) == compute_transactions_root(duplicated))
+    print('mutated (original): ', is_mutated_merkle_tree([get_leaf_hash(t) for t in texts]))
+    print('mutated (duplicated): ', is_mutated_merkle_tree([get_leaf_hash(t) for t in duplicated]))
+
+    block = Block(build_transactions(3), None, bits=MAX_TARGET_BITS).seal()
+    forged = block.to_dict()
+    forged['transactions'] = forged['transactions'] + [forged['transactions'][-1]]
+    forged_block = SealedBlock(forged)
+
+    # ヘッダが同じなのでハッシュ値も同じだが、重複を含む本体は受け入れない
+    print('same hash: ', block.hash == forged_block.hash)
+    print('original body is valid: ', block.has_valid_transactions_root())
+    print('forged body is valid: ', forged_block.has_valid_transactions_root())
+    assert block.has_valid_transactions_root()
+    assert not forged_block.has_valid_transactions_root()
+
+
+if __name__ == '__main__':
+    main()
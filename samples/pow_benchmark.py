@@ -0,0 +1,66 @@
+import json
+import hashlib
+import binascii
+
+from time import time
+
+from blockchain.block_header import BlockHeader, BLOCK_VERSION, DEFAULT_BITS, compute_transactions_root
+from blockchain.mining_engine import get_midstate, get_pow_digest
+
+
+ATTEMPTS = 20000
+
+
+def legacy_digest(message, nonce):
+    return binascii.hexlify(hashlib.sha256(hashlib.sha256((message + nonce).encode('utf-8')).digest()).digest()).decode('ascii')
+
+
+def build_transactions(tx_count):
+    transaction = {'inputs': [], 'outputs': [{'recipient': 'ab' * 270, 'value': 30}], 't_type': 'basic'}
+    return [json.dumps(transaction)] * tx_count
+
+
+def build_message(transactions):
+    block = {
+        'timestamp': time(),
+        'transactions': json.dumps(transactions),
+        'previous_block': '00' * 32,
+    }
+    return json.dumps(block, sort_keys=True)
+
+
+def build_header_prefix(transactions):
+    header = BlockHeader(BLOCK_VERSION, '00' * 32, compute_transactions_root(transactions), time(), DEFAULT_BITS)
+    return header.get_prefix()
+
+
+def measure(func):
+    started = time()
+    func()
+    return ATTEMPTS / (time() - started)
+
+
+def main():
+    for tx_count in (1, 10, 100, 1000):
+        transactions = build_transactions(tx_count)
+        message = build_message(transactions)
+        header_prefix = build_header_prefix(transactions)
+
+        def run_legacy():
+            # JSON + 10進数文字列のnonceを毎回全体ハッシュしてhex文字列で判定する従来の方式
+            for i in range(ATTEMPTS):
+                legacy_digest(message, str(i)).endswith('00000')
+
+        def run_header():
+            midstate = get_midstate(header_prefix)
+            for i in range(ATTEMPTS):
+                int.from_bytes(get_pow_digest(midstate, i), 'big') <= 0
+
+        legacy = measure(run_legacy)
+        header = measure(run_header)
+        print('{:>5} txs ({:>7} bytes): legacy {:>9.0f} h/s, header midstate {:>9.0f} h/s, x{:.1f}'.format(
+            tx_count, len(message), legacy, header, header / legacy))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,7 +10,7 @@ def main():
     print(t1.to_dict())
 
     t2 = Transaction(
-        [TransactionInput(t1, 0)],
+        [TransactionInput.from_transaction(t1.to_dict(), 0)],
         [TransactionOutput('Umika_pubkey', 10.0), TransactionOutput('Itsuki_pubkey', 20.0)]
     )
 
@@ -20,7 +20,7 @@ def main():
     t3 = CoinbaseTransaction(k_m.my_address())
 
     t4 = Transaction(
-        [TransactionInput(t1.to_dict(), 0)],
+        [TransactionInput.from_transaction(t1.to_dict(), 0)],
         [TransactionOutput(u_k_m.my_address(), 10.0),
         TransactionOutput(i_k_m.my_address(), 20.0)]
     )
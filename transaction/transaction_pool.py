@@ -1,43 +1,95 @@
 import threading
 
+from .transactions import get_outpoint, get_transaction_hash
+
 
 class TransactionPool:
     def __init__(self):
         print('Initializing TransactionPool...')
-        self.transactions = []
+        # Transactionのハッシュ値 -> Transaction(挿入順を保持する)
+        self.transactions = {}
+        # Inputとして使われている出力(outpoint) -> それを使うTransactionのハッシュ値
+        self.spent_outpoints = {}
         self.lock = threading.Lock()
 
-    def set_new_transaction(self, transaction):
+    def set_new_transaction(self, transaction, transaction_hash=None):
+        """
+        受信時などに計算済みのtxidがあれば渡すことで、再計算せずにそれをキーとして使う
+        """
+        if transaction_hash is None:
+            transaction_hash = get_transaction_hash(transaction)
         with self.lock:
             print('set_new_transaction is called', transaction)
-            self.transactions.append(transaction)
+            self.transactions[transaction_hash] = transaction
+            for txin in transaction.get('inputs', []):
+                self.spent_outpoints[get_outpoint(txin)] = transaction_hash
+
+    def __remove_transaction(self, transaction_hash):
+        transaction = self.transactions.pop(transaction_hash, None)
+        if transaction is None:
+            return
+        for txin in transaction.get('inputs', []):
+            outpoint = get_outpoint(txin)
+            if self.spent_outpoints.get(outpoint) == transaction_hash:
+                del self.spent_outpoints[outpoint]
+
+    def has_transaction(self, transaction_hash):
+        return transaction_hash in self.transactions
+
+    def get_transaction_hashes(self):
+        with self.lock:
+            return list(self.transactions)
 
     def clear_my_transactions(self, index):
         with self.lock:
             if index <= len(self.transactions):
-                new_transactions = self.transactions
-                del new_transactions[0:index]
-                print('transaction is now refreshed...', new_transactions)
-                self.transactions = new_transactions
+                for t_hash in list(self.transactions)[0:index]:
+                    self.__remove_transaction(t_hash)
+                print('transaction is now refreshed...', self.transactions)
+
+    def remove_transactions(self, transaction_hashes):
+        """
+        新しく接続されたブロックに含まれるTransactionを取り除く。処理量はブロック内のTransaction数に比例する
+        """
+        with self.lock:
+            for t_hash in transaction_hashes:
+                self.__remove_transaction(t_hash)
+
+    def remove_conflicting_transactions(self, outpoints):
+        """
+        チェーンに接続されたブロックで使用済みになった出力をInputに使うTransactionを取り除く
+        (ブロック内のものとtxidが違う二重使用はremove_transactionsでは取り除けないため)
+        """
+        with self.lock:
+            for outpoint in outpoints:
+                t_hash = self.spent_outpoints.get(outpoint)
+                if t_hash is not None:
+                    print('conflicting transaction is removed: ', t_hash)
+                    self.__remove_transaction(t_hash)
 
     def get_stored_transactions(self):
         if len(self.transactions) > 0:
-            return self.transactions
+            return list(self.transactions.values())
         else:
             print('Currently, it seems transaction pool is empty...')
             return []
 
-    def get_total_fee_from_tp(self):
+    def get_total_fee_from_tp(self, get_output):
         """
         TransactionPool内に格納されている全てのTransactionの手数料の合計値を算出する
+        Inputが参照する出力の金額はget_outputで解決する
         """
         print('get_total_fee_from_tp was called')
-        transactions = self.transactions
+        transactions = self.get_stored_transactions()
         result = 0
         for t in transactions:
             checked = self.check_type_of_transaction(t)
             if checked:
-                total_in = sum(i['transaction']['outputs'][i['output_index']]['value'] for i in t['inputs'])
+                total_in = 0
+                for i in t['inputs']:
+                    txout = get_output(get_outpoint(i))
+                    if txout is not None:
+                        total_in += txout.value
                 total_out = sum(o['value'] for o in t['outputs'])
                 delta = total_in - total_out
                 result += delta
@@ -53,18 +105,15 @@ class TransactionPool:
     def renew_my_transactions(self, transactions):
         with self.lock:
             print('transaction pool will be renewed to ...', transactions)
-            self.transactions = transactions
+            self.transactions = {get_transaction_hash(t): t for t in transactions}
+            self.spent_outpoints = {}
+            for t_hash, t in self.transactions.items():
+                for txin in t.get('inputs', []):
+                    self.spent_outpoints[get_outpoint(txin)] = t_hash
 
-    def has_this_output_in_my_tp(self, transaction_output):
+    def has_this_output_in_my_tp(self, transaction_input):
         """
-        TransactionPool内ですでにtransaction_outputがInputとして使われていないか確認
+        TransactionPool内ですでにtransaction_inputと同じ出力がInputとして使われていないか確認
         """
         print('has_this_output_in_my_tp was called')
-        transactions = self.transactions
-        for t in transactions:
-            inputs_t = t['inputs']
-            for it in inputs_t:
-                if it == transaction_output:
-                    return True
-
-        return False
+        return get_outpoint(transaction_input) in self.spent_outpoints
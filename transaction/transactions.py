@@ -1,12 +1,73 @@
+import sys
+import json
+import hashlib
+
 from time import time
 
 
+def get_transaction_hash(transaction):
+    """
+    Transactionのdictをキー順で正規化したJSONから求めるハッシュ値。インデックスのキーとして使う
+    """
+    transaction_text = json.dumps(transaction, sort_keys=True)
+    return hashlib.sha256(hashlib.sha256(transaction_text.encode('utf-8')).digest()).hexdigest()
+
+
+def get_outpoint(transaction_input):
+    """
+    TransactionInputが使用する出力を(参照先Transactionのハッシュ値, 出力のインデックス)で表す
+    """
+    return transaction_input['transaction_id'], transaction_input['output_index']
+
+
+def _has_str(d, *keys):
+    return all(isinstance(d.get(k), str) for k in keys)
+
+
+def is_well_formed_transaction(transaction):
+    """
+    インデックスの更新やブロックの検証で参照するキーが揃っているか確認する(署名や金額の正しさは見ない)
+    ネットワークから受け取ったTransactionはチェーンを変更する前にこれで確認し、途中でKeyErrorなどが起きないようにする
+    """
+    if not isinstance(transaction, dict) or not _has_str(transaction, 't_type'):
+        return False
+
+    t_type = transaction['t_type']
+    if t_type not in ('basic', 'coinbase_transaction'):
+        # SimpleBitcoin以外のTransactionは署名の検証に使うキーだけ確認する
+        return _has_str(transaction, 'sender', 'signature')
+
+    inputs = transaction.get('inputs')
+    outputs = transaction.get('outputs')
+    if not isinstance(inputs, list) or not isinstance(outputs, list):
+        return False
+    if t_type == 'basic' and not _has_str(transaction, 'signature'):
+        return False
+    # CoinbaseTransactionは先頭の出力の金額で報酬を確認する
+    if t_type == 'coinbase_transaction' and len(outputs) == 0:
+        return False
+
+    for txin in inputs:
+        if not isinstance(txin, dict) or not _has_str(txin, 'transaction_id'):
+            return False
+        if not isinstance(txin.get('output_index'), int):
+            return False
+    for txout in outputs:
+        if not isinstance(txout, dict) or not _has_str(txout, 'recipient'):
+            return False
+        if not isinstance(txout.get('value'), (int, float)):
+            return False
+
+    return True
+
+
 class Transaction:
     """
     送金可能なコインの総額を記録できるように、過去のトランザクションでの自分宛てへの送金記録と
     他のアドレスへの送金済み金額をinputsとoutputsのペアで管理する
     """
-    
+    __slots__ = ('inputs', 'outputs', 'timestamp', 't_type')
+
     def __init__(self, inputs, outputs):
         self.inputs = inputs
         self.outputs = outputs
@@ -23,7 +84,7 @@ class Transaction:
         return d
 
     def is_enough_inputs(self, fee):
-        total_in = sum(i.transaction['outputs'][i.output_index]['value'] for i in self.inputs)
+        total_in = sum(i.output.value for i in self.inputs)
         total_out = sum(int(o.value) for o in self.outputs) + int(fee)
         delta = total_in - total_out
 
@@ -34,18 +95,27 @@ class Transaction:
             return False
 
     def compute_change(self, fee):
-        total_in = sum(i.transaction['outputs'][i.output_index]['value'] for i in self.inputs)
+        total_in = sum(i.output.value for i in self.inputs)
         total_out = sum(int(o.value) for o in self.outputs) + int(fee)
         delta = total_in - total_out
         return delta
 
 
 class TransactionOutput:
+    """
+    UTXOのインデックスなど大量に保持されるので__slots__で小さくし、
+    同じアドレスへの出力どうしでアドレスの文字列を共有する
+    """
+    __slots__ = ('recipient', 'value')
 
     def __init__(self, recipient_address, value):
-        self.recipient = recipient_address
+        self.recipient = sys.intern(recipient_address)
         self.value = value
 
+    @classmethod
+    def from_dict(cls, txout):
+        return cls(txout['recipient'], txout['value'])
+
     def to_dict(self):
         d = {
             'recipient': self.recipient,
@@ -55,14 +125,26 @@ class TransactionOutput:
 
 
 class TransactionInput:
+    """
+    使用する出力を参照先Transactionのハッシュ値と出力のインデックスだけで指す
+    (参照先のTransactionを丸ごと埋め込むと、送金が続くたびにTransactionが際限なく大きくなるため)
+    """
+    __slots__ = ('transaction_id', 'output_index', 'output')
 
-    def __init__(self, transaction, output_index):
-        self.transaction = transaction
+    def __init__(self, transaction_id, output_index, output=None):
+        self.transaction_id = transaction_id
         self.output_index = output_index
+        # 参照先の出力(TransactionOutput)。送金額の計算に使うだけでTransactionには含めない
+        self.output = output
+
+    @classmethod
+    def from_transaction(cls, transaction, output_index):
+        output = TransactionOutput.from_dict(transaction['outputs'][output_index])
+        return cls(get_transaction_hash(transaction), output_index, output)
 
     def to_dict(self):
         d = {
-            'transaction': self.transaction,
+            'transaction_id': self.transaction_id,
             'output_index': self.output_index,
         }
         return d
@@ -72,6 +154,7 @@ class CoinbaseTransaction(Transaction):
     """
     Coinbaseトランザクションは例外的にInputを持たない
     """
+    __slots__ = ()
 
     def __init__(self, recipient_address, value=30):
         self.inputs = []
@@ -93,6 +176,11 @@ class EngravedTransaction:
     """
     value以外に任意のメッセージをTransactionに付加できる拡張Transactionタイプ
     """
+    __slots__ = (
+        'sender', 'sender_alt_name', 'icon', 'message', 'timestamp', 'reply_to', 'original_reply_to', 'content_id',
+        't_type',
+    )
+
     def __init__(self, sender, sender_alt_name, message, icon_url=None, reply_to=None, original_reply_to=None):
         self.sender = sender
         self.sender_alt_name = sender_alt_name
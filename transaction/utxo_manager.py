@@ -1,3 +1,6 @@
+from .transactions import get_outpoint, get_transaction_hash
+
+
 class UTXOManager:
     
     def __init__(self, address):
@@ -29,44 +32,31 @@ class UTXOManager:
     def extract_utxos(self, txs):
         """
         与えられたTransaction群の中からUTXOとして利用可能なもののみを抽出して保存する
+        Inputは使用した出力を(Transactionのハッシュ値, インデックス)で指すので、それに含まれない自分宛ての出力がUTXOになる
         """
         print('extract_utxos was called!')
-        outputs = []
-        inputs = []
-        idx = 0
-        for t in txs:
-            for txout in t['outputs']:
-                recipient = txout['recipient']
-                if recipient == self.my_address:
-                    outputs.append(t)
+        sbc_txs = [t for t in txs if self.is_sbc_transaction(t)[0]]
+        spent_outpoints = set()
+        for t in sbc_txs:
             for txin in t['inputs']:
-                t_in_txin = txin['transaction']
-                idx = txin['output_index']
-                o_recipient = t_in_txin['outputs'][idx]['recipient']
-                if o_recipient == self.my_address:
-                    inputs.append(t)
+                spent_outpoints.add(get_outpoint(txin))
 
-        if outputs is not []:
-            for o in outputs:
-                if inputs is not []:
-                    for i in inputs:
-                        for i_i in i['inputs']:
-                            if o == i_i['transaction']:
-                                outputs.remove(o)
-                else:
-                    break
-        else:
+        utxos = []
+        for t in sbc_txs:
+            t_hash = get_transaction_hash(t)
+            for idx, txout in enumerate(t['outputs']):
+                if txout['recipient'] == self.my_address and (t_hash, idx) not in spent_outpoints:
+                    utxos.append((t, idx))
+
+        if len(utxos) == 0:
             print('No Transaction for UTXO')
-            return
 
-        self._set_my_utxo_txs(outputs)
+        self._set_my_utxo_txs(utxos)
 
-    def _set_my_utxo_txs(self, txs):
+    def _set_my_utxo_txs(self, utxos):
         print('_set_my_utxo_txs was called')
-        self.utxo_txs = []
-
-        for t in txs:
-            self.put_utxo_tx(t)
+        self.utxo_txs = list(utxos)
+        self._compute_my_balance()
 
     def put_utxo_tx(self, tx):
         """
@@ -74,12 +64,9 @@ class UTXOManager:
         インデックスのタプルとして保存する
         """
         print('put_utxo_tx was called')
-        idx = 0
-        for txout in tx['outputs']:
+        for idx, txout in enumerate(tx['outputs']):
             if txout['recipient'] == self.my_address:
                 self.utxo_txs.append((tx, idx))
-            else:
-                idx += 1
 
         self._compute_my_balance()
 
@@ -92,12 +79,4 @@ class UTXOManager:
 
     def _compute_my_balance(self):
         print('_compute_my_balance was called')
-        balance = 0
-        txs = self.utxo_txs
-        for t in txs:
-            for txout in t[0]['outputs']:
-                print('txout: ', txout)
-                if txout['recipient'] == self.my_address:
-                    balance += txout['value']
-
-        self.my_balance = balance
+        self.my_balance = sum(t['outputs'][idx]['value'] for t, idx in self.utxo_txs)
@@ -1,17 +1,120 @@
 import copy
 import binascii
 import json
+import threading
+
+from collections import OrderedDict
 
 import Crypto
 from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5
 from Crypto.Hash import SHA256
 
+from transaction.transactions import get_outpoint, get_transaction_hash
+
+
+PUBKEY_CACHE_SIZE = 256
+SIGNATURE_CACHE_SIZE = 10000
+
 
 class RSAUtil:
-    
-    def __init__(self):
-        pass
+
+    def __init__(self, pubkey_cache_size=PUBKEY_CACHE_SIZE, signature_cache_size=SIGNATURE_CACHE_SIZE):
+        # アドレス(公開鍵のhex文字列) -> (インポート済みの公開鍵, 署名の検証用オブジェクト)
+        # 同じ送信者の鍵を何度も解析しないように、最近使ったものから一定数だけ保持する(LRU)
+        self.pubkey_cache = OrderedDict()
+        self.pubkey_cache_size = pubkey_cache_size
+        self.pubkey_cache_hits = 0
+        self.pubkey_cache_misses = 0
+        self.pubkey_cache_lock = threading.Lock()
+        # 検証に成功した(txid, 署名)の組。TransactionPoolへの受け入れ時、ブロックの検証時、他のピアからの中継時で
+        # 同じ署名を何度も検証しないように、1つのRSAUtilを共有して一定数だけ保持する
+        self.verified_signatures = OrderedDict()
+        self.signature_cache_size = signature_cache_size
+        self.signature_cache_hits = 0
+        self.signature_cache_misses = 0
+        self.signature_cache_lock = threading.Lock()
+
+    def get_pubkey_cache_stats(self):
+        return {
+            'hits': self.pubkey_cache_hits,
+            'misses': self.pubkey_cache_misses,
+            'size': len(self.pubkey_cache),
+        }
+
+    def get_signature_cache_stats(self):
+        return {
+            'hits': self.signature_cache_hits,
+            'misses': self.signature_cache_misses,
+            'size': len(self.verified_signatures),
+        }
+
+    def _has_verified_signature(self, cache_key):
+        with self.signature_cache_lock:
+            if cache_key in self.verified_signatures:
+                self.verified_signatures.move_to_end(cache_key)
+                self.signature_cache_hits += 1
+                return True
+            self.signature_cache_misses += 1
+            return False
+
+    def _add_verified_signature(self, cache_key):
+        with self.signature_cache_lock:
+            self.verified_signatures[cache_key] = True
+            self.verified_signatures.move_to_end(cache_key)
+            while len(self.verified_signatures) > self.signature_cache_size:
+                self.verified_signatures.popitem(last=False)
+
+    def _verify_transaction_sig(self, transaction, sender_pubkey_text, transaction_hash):
+        """
+        検証済みの(txid, 署名)であればRSAの計算を省略する。失敗した結果は参照先の出力が未知だった場合などに
+        後から成功し得るので保持しない
+        """
+        signature = transaction['signature']
+        if transaction_hash is None:
+            transaction_hash = get_transaction_hash(transaction)
+        cache_key = (transaction_hash, signature)
+        if self._has_verified_signature(cache_key):
+            print('signature is already verified')
+            return True
+
+        c_transaction = copy.deepcopy(transaction)
+        del c_transaction['signature']
+        target_txt = json.dumps(c_transaction, sort_keys=True)
+        result = self._verify_signature_by_address(target_txt, signature, sender_pubkey_text)
+        if result:
+            self._add_verified_signature(cache_key)
+
+        return result
+
+    def _get_pubkey_entry(self, pubkey_text):
+        with self.pubkey_cache_lock:
+            entry = self.pubkey_cache.get(pubkey_text)
+            if entry is not None:
+                self.pubkey_cache.move_to_end(pubkey_text)
+                self.pubkey_cache_hits += 1
+                return entry
+            self.pubkey_cache_misses += 1
+
+        # 鍵の解析は重いのでロックの外で行う
+        pubkey = RSA.importKey(binascii.unhexlify(pubkey_text))
+        entry = (pubkey, PKCS1_v1_5.new(pubkey))
+
+        with self.pubkey_cache_lock:
+            self.pubkey_cache[pubkey_text] = entry
+            self.pubkey_cache.move_to_end(pubkey_text)
+            while len(self.pubkey_cache) > self.pubkey_cache_size:
+                self.pubkey_cache.popitem(last=False)
+
+        return entry
+
+    def _verify_signature_by_address(self, message, signature, pubkey_text):
+        hashed_message = SHA256.new(message.encode('utf8'))
+        _, verifier = self._get_pubkey_entry(pubkey_text)
+        result = verifier.verify(hashed_message, binascii.unhexlify(signature))
+        print(result)
+
+        return result
 
     def verify_signature(self, message, signatrue, sender_public_key):
         print('verify_signature was called')
@@ -22,53 +125,50 @@ class RSAUtil:
         
         return result
 
-    def verify_sbc_transactions_sig(self, transaction):
+    def verify_sbc_transactions_sig(self, transaction, get_output, transaction_hash=None):
         """
         SimpleBitcoinのTransactionの署名の正当性を検証する
+        Inputは参照先の出力を(Transactionのハッシュ値, インデックス)で持つだけなので、get_outputで出力を解決する
+        計算済みのtxidがあればtransaction_hashに渡す
         """
 
         print('verify_sbc_transactions_sig was called')
-        sender_pubkey_text, used_outputs = self._get_pubkey_from_sbc_transaction(transaction)
-        signature = transaction['signature']
-        c_transaction = copy.deepcopy(transaction)
-        del c_transaction['signature']
-        target_txt = json.dumps(c_transaction, sort_keys=True)
-        sender_pubkey = RSA.importKey(binascii.unhexlify(sender_pubkey_text))
-        result = self.verify_signature(target_txt, signatrue, sender_pubkey)
+        sender_pubkey_text, used_outputs = self._get_pubkey_from_sbc_transaction(transaction, get_output)
+        if sender_pubkey_text is None:
+            print('referenced output is unknown')
+            return False, used_outputs
+
+        result = self._verify_transaction_sig(transaction, sender_pubkey_text, transaction_hash)
 
         return result, used_outputs
 
-    def _get_pubkey_from_sbc_transaction(self, transaction):
+    def _get_pubkey_from_sbc_transaction(self, transaction, get_output):
         print('_get_pubkey_from_sbc_transaction was called')
         input_t_list = transaction['inputs']
         used_outputs = []
-        sender_pubkey = ''
+        sender_pubkey = None
 
         for i in input_t_list:
-            idx = i['output_index']
-            tx = i['transaction']['outputs'][idx]
-            used_outputs.append(tx)
-            sender_pubkey = tx['recipient']
+            txout = get_output(get_outpoint(i))
+            if txout is None:
+                return None, used_outputs
+            used_outputs.append(txout)
+            sender_pubkey = txout.recipient
 
         return sender_pubkey, used_outputs
 
-    def verify_general_transaction_sig(self, transaction):
+    def verify_general_transaction_sig(self, transaction, transaction_hash=None):
         """
         SimpleBitcoin以外のTransactionも署名の形式を統一することで検証を可能にしておく
         """
         print('verify_general_transaction_sig was called')
         sender_pubkey_text = transaction['sender']
-        signatrue = transaction['signature']
-        c_transaction = copy.deepcopy(transaction)
-        del c_transaction['signature']
-        target_txt = json.dumps(c_transaction, sort_keys=True)
-        sender_pubkey = RSA.importKey(binascii.unhexlify(sender_pubkey_text))
-        result = self.verify_signature(target_txt, signature, sender_pubkey)
+        result = self._verify_transaction_sig(transaction, sender_pubkey_text, transaction_hash)
 
         return result
 
     def encrypt_with_pubkey(self, target, pubkey_text):
-        pubkey = RSA.importKey(binascii.unhexlify(pubkey_text))
+        pubkey, _ = self._get_pubkey_entry(pubkey_text)
         encrypto = pubkey.encrypt(target, 0)
         return encrypto
 
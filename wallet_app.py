@@ -201,7 +201,7 @@ class SimpleBC_Gui(Frame):
         pass
 
     def update_block_chain(self):
-        self.c_core.send_req_full_chain_to_my_core_node()
+        self.c_core.send_req_blocks_to_my_core_node()
 
     def renew_my_keypairs(self):
         # TODO: 新規アドレスになるので所有コインを0に更新する
@@ -328,7 +328,7 @@ class SimpleBC_Gui(Frame):
             utxo, idx = self.um.get_utxo_tx(0)
 
             t = Transaction(
-                [TransactionInput(utxo, idx)],
+                [TransactionInput.from_transaction(utxo, idx)],
                 [TransactionOutput(recipientKey, sendAtp)]
             )
 
@@ -337,7 +337,7 @@ class SimpleBC_Gui(Frame):
             # TransactionInputが送金額に達するまでUTXOを収集しTransactionを完成させる
             while t.is_enough_inputs(sendFee) is not True:
                 new_utxo, new_idx = self.um.get_utxo_tx(counter)
-                t.inputs.append(TransactionInput(new_utxo, new_idx))
+                t.inputs.append(TransactionInput.from_transaction(new_utxo, new_idx))
                 counter += 1
                 if counter > len(self.um.utxo_txs):
                     messagebox.showwarning('Short of Coinn.', 'Not enough coin to be sent...')
@@ -356,7 +356,8 @@ class SimpleBC_Gui(Frame):
                 self.c_core.send_message_to_my_core_node(MSG_NEW_TRANSACTION, tx_strings)
                 print('signed new_tx: ', tx_strings)
 
-                self.um.put_utxo_tx(t.to_dict())
+                # お釣りは署名済みのTransactionのハッシュ値で参照されるので署名込みで保存する
+                self.um.put_utxo_tx(new_tx)
 
                 to_be_deleted = 0
                 del_list = []